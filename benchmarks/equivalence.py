@@ -0,0 +1,359 @@
+"""Checks that rescore_logic still scores games the way it used to, for changes meant to make it faster rather than
+change what it writes.
+
+    python -m benchmarks.equivalence                                   # against the saved reference
+    python -m benchmarks.equivalence --save-reference --ref=<commit>   # record what another commit scores
+
+The reference (benchmarks/baselines/equivalence.json) has a digest of every record an older commit wrote for a fixed
+set of synthetic games, scored dry and by fake_engine.InProcessEngine. The one checked in is from the first commit of
+the repo. Positions with a single legal move aren't searched any more, they take their q from the next position, so
+q is left out of their digest. Everything else has to match byte for byte.
+
+The other checks need no reference: engine history and full-policy rescoring against plain scoring, move inference
+from bitboards, the policy index <-> move tables against the string conversions they replaced for every legal move
+of positions with either side to move, and the node budget's average. Exits with status 1 if anything fails.
+"""
+import argparse
+import asyncio
+import gzip
+import hashlib
+import io
+import json
+import os
+import pickle
+import random
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+import chess
+import np
+
+from benchmarks import fake_engine
+from benchmarks import synthetic_games
+import constants
+import rescore_logic
+import search_plan
+import v4
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_REFERENCE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines', 'equivalence.json')
+# Most failures printed per check
+MAX_REPORTED = 5
+
+# What random games rarely reach: castling both ways, promotions with and without a capture, en passant, and a rook
+# playing the e1g1 and e1c1 that lc0 would read as castling. Each with white and with black to move.
+SPECIAL_POSITIONS = (
+    'r3k2r/8/8/8/8/8/8/R3K2R w KQkq - 0 1',
+    'r3k2r/8/8/8/8/8/8/R3K2R b KQkq - 0 1',
+    '1n2k3/P7/8/8/8/8/p7/1N2K3 w - - 0 1',
+    '1n2k3/P7/8/8/8/8/p7/1N2K3 b - - 0 1',
+    '4k3/8/8/3pP3/8/8/8/4K3 w - d6 0 1',
+    '4k3/8/8/8/3Pp3/8/8/4K3 b - d3 0 1',
+    '3k4/8/8/8/8/8/8/K3R3 w - - 0 1',
+    'k3r3/8/8/8/8/8/8/3K4 b - - 0 1',
+)
+
+# (average, min, max) nodes the budget is checked with
+BUDGET_SETTINGS = ((16, 1, 64), (16, 8, 64), (16, 16, 64), (4, 4, 4), (128, 16, 512), (1, 1, 1))
+
+
+def make_games(num_games, seed, max_plies):
+    rng = random.Random(seed)
+    return [synthetic_games.random_game(rng, max_plies) for _ in range(num_games)]
+
+
+def with_random_policy(data, seed):
+    """The same game with a random policy over the legal moves of every position instead of the one-hot one."""
+    game = v4.V4Game(bytearray(data))
+    probs = game.probs
+    legal = ~np.isnan(probs)
+    probs[legal] = np.random.default_rng(seed).random(np.count_nonzero(legal)).astype(np.float32) + np.float32(0.01)
+    probs /= np.nansum(probs, axis=1, keepdims=True)
+    return bytes(game.data)
+
+
+def ending_on_forced_moves(games):
+    """Each game cut short at its first position with a single legal move, so it's the last one scored."""
+    cut = []
+    for data in games:
+        forced = np.flatnonzero(v4.V4Game(data).legal_move_counts() == 1)
+        if len(forced):
+            cut.append(data[:(forced[0] + 1) * constants.V4_BYTES])
+    return cut
+
+
+def score_games(games, engine, num_nodes, **kwargs):
+    """score_file for every game, uncompressed outputs."""
+    async def score_all():
+        # The inputs only have to be valid gzip, and level 9 would take longer than scoring them
+        return [
+            gzip.decompress(await rescore_logic.score_file(gzip.compress(data, 1), engine, num_nodes, **kwargs))
+            for data in games
+        ]
+    return asyncio.run(score_all())
+
+
+def record_digests(output, data):
+    """Digest of every record of a scored game, without q at positions that have a single legal move in data."""
+    game = v4.V4Game(bytearray(output))
+    forced = v4.V4Game(data).legal_move_counts()[:len(game)] == 1
+    game['root_q'][forced] = 0
+    game['best_q'][forced] = 0
+    return [hashlib.sha1(record.tobytes()).hexdigest()[:12] for record in game.records]
+
+
+def digest_outputs(games, outputs):
+    return dict(
+        dry=[hashlib.sha1(output).hexdigest()[:12] for output in outputs['dry']],
+        engine=[record_digests(output, data) for output, data in zip(outputs['engine'], games)],
+    )
+
+
+def record_reference(ref, games, num_nodes):
+    """Digests of what commit ref scores for games, from that commit's rescore_logic run in its own process."""
+    archive = subprocess.run(['git', 'archive', ref], cwd=REPO_DIR, check=True, stdout=subprocess.PIPE).stdout
+    with tempfile.TemporaryDirectory() as tree:
+        with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+            # benchmarks comes from this tree, so the scorer and engine are the same whatever ref has
+            tar.extractall(tree, members=[m for m in tar.getmembers() if not m.name.startswith('benchmarks')])
+        games_path = os.path.join(tree, 'games.pickle')
+        outputs_path = os.path.join(tree, 'outputs.pickle')
+        with open(games_path, 'wb') as f:
+            pickle.dump(games, f)
+        # The working directory comes first on the path, ahead of this tree
+        subprocess.run(
+            [sys.executable, '-m', 'benchmarks.reference_scores', games_path, outputs_path, str(num_nodes)],
+            cwd=tree,
+            env=dict(os.environ, PYTHONPATH=REPO_DIR),
+            check=True,
+        )
+        with open(outputs_path, 'rb') as f:
+            return digest_outputs(games, pickle.load(f))
+
+
+# Each check returns a list of what failed. plain is what score_file writes for the games with
+# fake_engine.InProcessEngine and nothing else set, which several of them compare against
+
+def check_reference(games, plain, reference):
+    outputs = dict(dry=score_games(games, None, reference['num_nodes']), engine=plain)
+    digests = digest_outputs(games, outputs)
+    failures = []
+    for i, (expected, got) in enumerate(zip(reference['dry'], digests['dry'])):
+        if expected != got:
+            failures.append(f'game {i} scored dry differs')
+    for i, (expected, got) in enumerate(zip(reference['engine'], digests['engine'])):
+        if len(expected) != len(got):
+            failures.append(f'game {i} has {len(got)} scored records, the reference has {len(expected)}')
+            continue
+        differing = [j for j, (a, b) in enumerate(zip(expected, got)) if a != b]
+        if differing:
+            failures.append(f'game {i} differs at {len(differing)} records, the first is {differing[0]}')
+    return failures
+
+
+def check_engine_history(games, plain, num_nodes):
+    # InProcessEngine answers the real board like the mirrored one, so only the way of asking differs
+    history = score_games(games, fake_engine.InProcessEngine(), num_nodes, engine_history=True)
+    return [f'game {i} differs with engine history' for i, (a, b) in enumerate(zip(plain, history)) if a != b]
+
+
+def check_full_policies(games, plain, num_nodes):
+    """Rescoring a game with a full policy has to give what scoring it unscored does. The old policy is cleared
+    first, where an unscored game keeps its p=1 on the move played if the engine doesn't visit it
+    (q_and_probs_from_engine_score only writes the moves it visited), so those entries are left out."""
+    full_games = [with_random_policy(data, seed) for seed, data in enumerate(games)]
+    rescored = score_games(full_games, fake_engine.InProcessEngine(), num_nodes, rescore_full_policies=True)
+    skipped = score_games(full_games, fake_engine.InProcessEngine(), num_nodes)
+    failures = []
+    for i, (data, full_data, a, b, c) in enumerate(zip(games, full_games, plain, rescored, skipped)):
+        if c != full_data:
+            failures.append(f'game {i} with a full policy was changed without rescore_full_policies')
+        plain_game, rescored_game = v4.V4Game(bytearray(a)), v4.V4Game(b)
+        if len(plain_game) != len(rescored_game):
+            failures.append(f'game {i} rescored has {len(rescored_game)} records, scored {len(plain_game)}')
+            continue
+        left_over = (v4.V4Game(data).probs[:len(plain_game)] == 1) & (plain_game.probs == 1) & (rescored_game.probs == 0)
+        plain_game.probs[left_over] = 0
+        if bytes(plain_game.data) != b:
+            failures.append(f'game {i} rescored from a full policy differs from scoring it unscored')
+    return failures
+
+
+def check_infer_move(games):
+    failures = []
+    for i, data in enumerate(games):
+        game = v4.V4Game(data)
+        _, played_moves = game.unscored_moves()
+        bitboards = rescore_logic.game_piece_masks(game).tolist()
+        board = chess.Board()
+        for j in range(len(game) - 1):
+            move = rescore_logic.move_from_policy_index(int(played_moves[j]), board)
+            inferred = rescore_logic.infer_move(board, bitboards[j + 1])
+            if inferred != move:
+                failures.append(f'game {i} record {j}: {move} played, {inferred} inferred')
+            board.push(move)
+    return failures
+
+
+def game_boards(games):
+    """A board for every position of games, then SPECIAL_POSITIONS."""
+    boards = []
+    for data in games:
+        game = v4.V4Game(data)
+        _, played_moves = game.unscored_moves()
+        board = chess.Board()
+        for index in played_moves.tolist():
+            boards.append(board.copy(stack=False))
+            board.push(rescore_logic.move_from_policy_index(index, board))
+    return boards + [chess.Board(fen) for fen in SPECIAL_POSITIONS]
+
+
+def check_policy_tables(games):
+    """policy_index and move_from_policy_index against the string conversions they replaced, which worked on the
+    board mirrored so the side to move is white, for every legal move."""
+    failures = []
+    for board in game_boards(games):
+        white = board.turn == chess.WHITE
+        side_board = board if white else board.mirror()
+        indices = set()
+        for move in board.legal_moves:
+            side_move = move if white else rescore_logic.flip_move(move)
+            expected = constants.MOVES_LOOKUP[rescore_logic.unclean_uci_move_to_lc0(side_move.uci(), side_board)]
+            index = rescore_logic.policy_index(move, board)
+            back = rescore_logic.move_from_policy_index(index, board)
+            if index != expected:
+                failures.append(f'{board.fen()} {move}: policy index {index}, the string conversion gives {expected}')
+            if back != move:
+                failures.append(f'{board.fen()} {move}: policy index {index} turns back into {back}')
+            if index in indices:
+                failures.append(f'{board.fen()} {move}: policy index {index} shared with another move')
+            indices.add(index)
+    return failures
+
+
+def check_node_budget(games, num_nodes, seed):
+    """NodeBudget on its own never more than a node ahead of the average, and score_file charging it for every
+    node it asks the engine for, first passes and forced moves searched at the end of a game included."""
+    failures = []
+    rng = random.Random(seed)
+    for average, min_nodes, max_nodes in BUDGET_SETTINGS:
+        for mode in search_plan.ADAPTIVE_MODES:
+            budget = search_plan.NodeBudget(average, min_nodes, max_nodes, mode)
+            for _ in range(10000):
+                # Like _score_position: forced moves ask for uncertainty 0, first-pass positions pay for a 1 node search
+                forced = rng.random() < 0.05
+                if mode == 'first-pass' and not forced:
+                    budget.spend(1)
+                nodes = budget.nodes_for(0 if forced else rng.random() ** 3)
+                if not 1 <= nodes <= max_nodes:
+                    failures.append(f'{mode} {average}/{min_nodes}/{max_nodes}: gave out {nodes} nodes')
+                if mode == 'entropy' or forced or nodes > 1:
+                    budget.spend(nodes)
+                if budget.nodes_spent > average * budget.num_positions + 1:
+                    failures.append(
+                        f'{mode} {average}/{min_nodes}/{max_nodes}: {budget.nodes_spent} nodes spent over '
+                        f'{budget.num_positions} positions'
+                    )
+                    break
+
+    cut_games = ending_on_forced_moves(games)
+    if not cut_games:
+        failures.append('no game has a position with a single legal move to end on')
+    full_games = [with_random_policy(data, seed) for seed, data in enumerate(games + cut_games)]
+    for mode, scored_games in ((None, games + cut_games), ('first-pass', games + cut_games), ('entropy', full_games)):
+        budget = None if mode is None else search_plan.NodeBudget(num_nodes, 2, 4 * num_nodes, mode)
+        engine = fake_engine.InProcessEngine()
+        search_stats = search_plan.SearchStats()
+        score_games(
+            scored_games,
+            engine,
+            num_nodes,
+            rescore_full_policies=True,
+            search_stats=search_stats,
+            node_budget=budget,
+        )
+        counts = search_stats.counts
+        if (counts['engine_calls'], counts['nodes']) != (engine.num_calls, engine.num_nodes):
+            failures.append(
+                f'{mode}: stats count {counts["engine_calls"]} engine calls and {counts["nodes"]} nodes, the engine '
+                f'got {engine.num_calls} and {engine.num_nodes}'
+            )
+        if budget is not None:
+            if budget.nodes_spent != engine.num_nodes:
+                failures.append(f'{mode}: budget charged {budget.nodes_spent} nodes, the engine got {engine.num_nodes}')
+            if budget.nodes_spent > num_nodes * budget.num_positions + 1:
+                failures.append(f'{mode}: {budget.nodes_spent} nodes spent over {budget.num_positions} positions')
+    return failures
+
+
+def save_reference(path, reference):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(reference, f, separators=(',', ':'))
+        f.write('\n')
+
+
+def main(args):
+    if args.save_reference:
+        games = make_games(args.num_games, args.seed, args.max_plies)
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short=12', args.ref], cwd=REPO_DIR, check=True, stdout=subprocess.PIPE,
+        ).stdout.decode().strip()
+        reference = dict(
+            commit=commit,
+            num_games=args.num_games,
+            seed=args.seed,
+            max_plies=args.max_plies,
+            num_nodes=args.num_nodes,
+            **record_reference(commit, games, args.num_nodes),
+        )
+        save_reference(args.reference_path, reference)
+        print(f'saved what {commit} scores for {len(games)} games to {args.reference_path}')
+        return
+
+    with open(args.reference_path) as f:
+        reference = json.load(f)
+    games = make_games(reference['num_games'], reference['seed'], reference['max_plies'])
+    num_nodes = reference['num_nodes']
+    print(f'{len(games)} games, {sum(len(data) for data in games) // constants.V4_BYTES} positions, '
+          f'reference from {reference["commit"]}')
+    plain = score_games(games, fake_engine.InProcessEngine(), num_nodes)
+    checks = [
+        ('reference', lambda: check_reference(games, plain, reference)),
+        ('engine_history', lambda: check_engine_history(games, plain, num_nodes)),
+        ('full_policies', lambda: check_full_policies(games, plain, num_nodes)),
+        ('infer_move', lambda: check_infer_move(games)),
+        ('policy_tables', lambda: check_policy_tables(games)),
+        ('node_budget', lambda: check_node_budget(games, num_nodes, reference['seed'])),
+    ]
+    num_failed = 0
+    for name, check in checks:
+        if args.filter and args.filter not in name:
+            continue
+        failures = check()
+        print(f'{name:16} {"ok" if not failures else f"{len(failures)} failures"}')
+        for failure in failures[:MAX_REPORTED]:
+            print(f'    {failure}')
+        num_failed += bool(failures)
+    if num_failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--reference-path', dest='reference_path', default=DEFAULT_REFERENCE_PATH)
+    parser.add_argument('--filter', dest='filter', default='', help='only run checks with this in their name')
+    parser.add_argument(
+        '--save-reference',
+        dest='save_reference',
+        action='store_true',
+        help='record what --ref scores to --reference-path instead of checking',
+    )
+    parser.add_argument('--ref', dest='ref', default='HEAD', help='commit to record the reference from')
+    parser.add_argument('--num-games', dest='num_games', type=int, default=16)
+    parser.add_argument('--seed', dest='seed', type=int, default=0)
+    parser.add_argument('--max-plies', dest='max_plies', type=int, default=300)
+    parser.add_argument('--num-nodes', dest='num_nodes', type=int, default=16)
+    main(parser.parse_args())
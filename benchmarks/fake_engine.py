@@ -0,0 +1,142 @@
+"""Stand-in for lc0 that speaks just enough UCI for rescore_client, so the pipeline can be benchmarked without a GPU.
+
+Every `go` sleeps FAKE_ENGINE_LATENCY_MS milliseconds plus FAKE_ENGINE_NODE_LATENCY_MS per node, then reports MultiPV
+random legal moves, the requested nodes split between them, the way lc0 reports them.
+"""
+import os
+import random
+import sys
+import time
+
+import chess
+import chess.engine
+
+# Everything rescore_client configures has to be declared, python-chess refuses to set unknown options
+OPTIONS = (
+    'option name WeightsFile type string default <autodiscover>',
+    'option name Threads type spin default 1 min 1 max 128',
+    'option name MinibatchSize type spin default 1 min 1 max 1024',
+    'option name ScoreType type combo default centipawn var centipawn var Q',
+    'option name Backend type string default fake',
+    'option name BackendOptions type string default',
+    'option name MultiPV type spin default 1 min 1 max 500',
+)
+
+
+def send(line):
+    sys.stdout.write(line + '\n')
+    sys.stdout.flush()
+
+
+def parse_position(tokens, board=None, previous_tokens=None):
+    """The board for a position command. When it carries on from the previous one (same start, more moves), the
+    new moves are pushed onto that board, the way lc0 picks up where it was rather than starting over."""
+    if board is not None and previous_tokens and len(tokens) > len(previous_tokens) \
+            and tokens[:len(previous_tokens)] == previous_tokens and 'moves' in previous_tokens:
+        for move in tokens[len(previous_tokens):]:
+            board.push_uci(move)
+        return board
+    if tokens[0] == 'startpos':
+        board = chess.Board()
+        rest = tokens[1:]
+    else:
+        # position fen <6 fields> [moves ...]
+        board = chess.Board(' '.join(tokens[1:7]))
+        rest = tokens[7:]
+    if rest and rest[0] == 'moves':
+        for move in rest[1:]:
+            board.push_uci(move)
+    return board
+
+
+def search(board, nodes, multipv, rng):
+    """(move, nodes, centipawns) for up to multipv random legal moves, the nodes split between them. Most of the
+    visits go to the first move, like a real search."""
+    legal_moves = list(board.legal_moves)
+    moves = rng.sample(legal_moves, min(multipv, len(legal_moves)))
+    lines = []
+    remaining = nodes
+    for i, move in enumerate(moves, start=1):
+        move_nodes = remaining if i == len(moves) else (remaining + 1) // 2
+        remaining -= move_nodes
+        lines.append((move, move_nodes, rng.randint(-300, 300)))
+    return lines
+
+
+def go(board, tokens, multipv, rng, latency, node_latency):
+    nodes = 1
+    if 'nodes' in tokens:
+        nodes = int(tokens[tokens.index('nodes') + 1])
+    time.sleep(latency + node_latency * nodes)
+
+    lines = search(board, nodes, multipv, rng)
+    if not lines:
+        send('info depth 0 score mate 0')
+        send('bestmove (none)')
+        return
+    for i, (move, move_nodes, centipawns) in enumerate(lines, start=1):
+        send(f'info depth 1 seldepth 1 time 0 nodes {move_nodes} score cp {centipawns} multipv {i} pv {move.uci()}')
+    send(f'bestmove {lines[0][0].uci()}')
+
+
+class InProcessEngine:
+    """search() behind python-chess's engine.analyse(), for scoring games without an engine process. Every position
+    gets the same answer every time, and calls and nodes asked for are counted.
+
+    Positions with black to move, which score_file only sends with engine_history, are answered the way their
+    mirror image with white to move is, so both ways of asking about a position agree.
+    """
+    def __init__(self):
+        self.num_calls = 0
+        self.num_nodes = 0
+
+    async def analyse(self, board, limit, multipv=1):
+        self.num_calls += 1
+        self.num_nodes += limit.nodes
+        frame = board if board.turn == chess.WHITE else board.mirror()
+        lines = search(frame, limit.nodes, multipv, random.Random(frame.epd()))
+        if board.turn == chess.BLACK:
+            lines = [
+                (chess.Move(chess.square_mirror(move.from_square), chess.square_mirror(move.to_square), move.promotion),
+                 nodes, centipawns)
+                for move, nodes, centipawns in lines
+            ]
+        return [
+            dict(score=chess.engine.PovScore(chess.engine.Cp(centipawns), board.turn), pv=[move], nodes=nodes)
+            for move, nodes, centipawns in lines
+        ]
+
+
+def main():
+    rng = random.Random(os.getpid())
+    latency = float(os.environ.get('FAKE_ENGINE_LATENCY_MS', 1)) / 1000
+    node_latency = float(os.environ.get('FAKE_ENGINE_NODE_LATENCY_MS', 0)) / 1000
+    board = chess.Board()
+    position_tokens = None
+    multipv = 1
+    for line in sys.stdin:
+        tokens = line.split()
+        if not tokens:
+            continue
+        command = tokens[0]
+        if command == 'uci':
+            send('id name fake_engine')
+            send('id author leelenscorer')
+            for option in OPTIONS:
+                send(option)
+            send('uciok')
+        elif command == 'isready':
+            send('readyok')
+        elif command == 'setoption' and len(tokens) >= 5 and tokens[2].lower() == 'multipv':
+            multipv = int(tokens[4])
+        elif command == 'position':
+            board = parse_position(tokens[1:], board, position_tokens)
+            position_tokens = tokens[1:]
+        elif command == 'go':
+            go(board, tokens, multipv, rng, latency, node_latency)
+        elif command == 'quit':
+            return
+
+
+if __name__ == '__main__':
+    main()
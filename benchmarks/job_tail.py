@@ -0,0 +1,120 @@
+"""Checks how evenly the end of a job is spread over clients, by simulating clients against game_server's
+ChunkSizer with and without the end-of-job cap (game_server.tail_chunk_size and rate_share).
+
+    python -m benchmarks.job_tail
+
+Each client scores its chunks one after another at a fixed number of seconds per file and keeps --window chunks in
+flight, like rescore_client with --pipeline-depth. Clients connect a little apart. The job takes as long as the
+last client to finish, which is compared with the time the files would take if every client stopped at the same
+moment. Exits with status 1 if the capped job takes more than --tolerance longer than that, plus one file.
+"""
+import argparse
+from collections import namedtuple
+import heapq
+import sys
+
+import game_server
+
+Scenario = namedtuple('Scenario', ['name', 'num_files', 'seconds_per_file', 'connect_gap'])
+
+SCENARIOS = [
+    Scenario('3 clients, 60 files', 60, [0.3, 0.3, 0.3], 2),
+    Scenario('3 clients, 600 files', 600, [0.3, 0.3, 0.3], 2),
+    Scenario('8 clients, 5000 files', 5000, [1.0] * 8, 5),
+    Scenario('4 mixed clients, 2000 files', 2000, [0.5, 1.0, 1.0, 2.0], 5),
+    Scenario('16 mixed clients, 20000 files', 20000, [0.5, 1.0, 2.0, 4.0] * 4, 1),
+]
+
+
+def simulate(scenario, capped, window, requested_size, chunk_sizing):
+    """Returns (seconds until the last file is scored, files each client scored)."""
+    remaining = scenario.num_files
+    num_clients = len(scenario.seconds_per_file)
+    sizers = [None] * num_clients
+    fleet = [game_server.ClientStats() for _ in range(num_clients)]
+    busy_until = [0] * num_clients
+    last_result = [0] * num_clients
+    in_flight = [0] * num_clients
+    scored = [0] * num_clients
+    # (time, order, client, chunk size), chunk size None for a client connecting
+    events = [(i * scenario.connect_gap, i, i, None) for i in range(num_clients)]
+    order = num_clients
+    finish = 0
+
+    while events:
+        now, _, client, size = heapq.heappop(events)
+        if size is None:
+            sizers[client] = game_server.ChunkSizer(fleet[client], requested_size, *chunk_sizing)
+            fleet[client].num_attached_clients = 1
+            last_result[client] = now
+        else:
+            in_flight[client] -= 1
+            scored[client] += size
+            sizers[client].record(size, now - last_result[client])
+            last_result[client] = now
+            finish = max(finish, now)
+
+        while remaining and in_flight[client] < window:
+            size = sizers[client].chunk_size
+            if capped:
+                share = game_server.rate_share(fleet[client], fleet)
+                size = game_server.tail_chunk_size(size, remaining, share, window)
+            size = min(size, remaining)
+            remaining -= size
+            in_flight[client] += 1
+            busy_until[client] = max(busy_until[client], now) + size * scenario.seconds_per_file[client]
+            heapq.heappush(events, (busy_until[client], order, client, size))
+            order += 1
+    return finish, scored
+
+
+def ideal_seconds(scenario):
+    """Every client busy from when it connects until one shared end time."""
+    rates = [1 / s for s in scenario.seconds_per_file]
+    connect_times = [i * scenario.connect_gap for i in range(len(rates))]
+    # Bisect the end time at which the clients together get through every file
+    low, high = 0, max(connect_times) + scenario.num_files * max(scenario.seconds_per_file)
+    for _ in range(100):
+        end = (low + high) / 2
+        done = sum(rate * max(0, end - start) for rate, start in zip(rates, connect_times))
+        low, high = (end, high) if done < scenario.num_files else (low, end)
+    return high
+
+
+def main(args):
+    chunk_sizing = (args.target_chunk_seconds, args.min_chunk_size, args.max_chunk_size)
+    failed = False
+    for scenario in SCENARIOS:
+        ideal = ideal_seconds(scenario)
+        uncapped, _ = simulate(scenario, False, args.window, args.requested_size, chunk_sizing)
+        capped, scored = simulate(scenario, True, args.window, args.requested_size, chunk_sizing)
+        limit = ideal * (1 + args.tolerance) + max(scenario.seconds_per_file)
+        ok = capped <= limit
+        failed |= not ok
+        print(f'{"ok  " if ok else "FAIL"} {scenario.name:32} ideal {ideal:8.1f}s  uncapped {uncapped:8.1f}s  '
+              f'capped {capped:8.1f}s  files per client {scored}')
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--window', dest='window', type=int, default=2, help='chunks each client keeps in flight')
+    parser.add_argument(
+        '--requested-size',
+        dest='requested_size',
+        type=int,
+        default=10,
+        help='chunk size clients ask for, used until the server has measured their rate'
+    )
+    parser.add_argument('--target-chunk-seconds', dest='target_chunk_seconds', type=float, default=60)
+    parser.add_argument('--min-chunk-size', dest='min_chunk_size', type=int, default=1)
+    parser.add_argument('--max-chunk-size', dest='max_chunk_size', type=int, default=500)
+    parser.add_argument(
+        '--tolerance',
+        dest='tolerance',
+        type=float,
+        default=0.1,
+        help='how much longer than ideal the capped job may take, as a fraction'
+    )
+    main(parser.parse_args())
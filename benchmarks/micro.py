@@ -0,0 +1,385 @@
+"""Nanoseconds per position for the rescore_logic functions that run on every position of every game.
+
+    python -m benchmarks.micro --save-baseline     # before a change
+    python -m benchmarks.micro                     # after it, compared against the saved baseline
+
+The corpus is a fixed set of synthetic games (same --seed, same games) or the games in --games-folder, with engine
+output recorded from the fake engine's search for every position, so runs are comparable with each other.
+"""
+import argparse
+import asyncio
+from collections import namedtuple
+import gc
+import gzip
+import json
+import math
+import os
+import platform
+import random
+import time
+
+import chess
+import chess.engine
+import np
+
+from benchmarks import fake_engine
+from benchmarks import synthetic_games
+import constants
+import rescore_logic
+import search_plan
+import v4
+
+DEFAULT_BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines', 'micro.json')
+
+Position = namedtuple(
+    'Position',
+    [
+        'encoding',
+        'game',
+        'index',
+        'probs',
+        'board',
+        'move',
+        'lc0_move',
+        'infos',
+        'next_planes',
+        'next_bitboards',
+        'num_legal_moves',
+    ],
+)
+Corpus = namedtuple('Corpus', ['games', 'compressed_games', 'num_game_positions', 'positions', 'num_nodes'])
+
+
+class RecordedEngine:
+    """Answers analyse() with the infos recorded for the position asked about. Positions are told apart by their
+    pieces, which is cheap enough not to show up next to what's being timed, since the search planner means not
+    every position gets asked about."""
+    def __init__(self, positions):
+        self.infos = dict(
+            (tuple(rescore_logic.board_piece_masks(position.board)), position.infos) for position in positions
+        )
+
+    async def analyse(self, board, limit, multipv=None):
+        return self.infos[tuple(rescore_logic.board_piece_masks(board))]
+
+
+def load_games(games_folder, num_games, seed):
+    if not games_folder:
+        rng = random.Random(seed)
+        return [synthetic_games.random_game(rng) for _ in range(num_games)]
+    games = []
+    for root, _, filenames in os.walk(games_folder):
+        for filename in sorted(filenames):
+            if filename.endswith('.gz') and len(games) < num_games:
+                with open(os.path.join(root, filename), 'rb') as f:
+                    games.append(gzip.decompress(f.read()))
+    return games
+
+
+def build_corpus(games, num_nodes, seed):
+    """Replays every game the way score_file does, keeping what each per-position function gets called with."""
+    rng = random.Random(seed)
+    multipv = math.ceil(num_nodes / 2)
+    positions = []
+    num_game_positions = 0
+    for data in games:
+        encodings = list(rescore_logic.parse_game(data))
+        # Writable copy for the functions that score in place
+        game = v4.V4Game(bytearray(data))
+        num_game_positions += len(encodings)
+        board = chess.Board()
+        for i, encoding in enumerate(encodings):
+            probs = np.frombuffer(encoding.probs, dtype=np.float32)
+            if len(board.piece_map()) <= 5 or not rescore_logic._is_single_probability_encoding(probs):
+                break
+            lc0_move = constants.MOVES[np.nanargmax(probs)]
+            move = rescore_logic.move_from_policy_index(constants.MOVES_LOOKUP[lc0_move], board)
+            infos = [
+                dict(score=chess.engine.PovScore(chess.engine.Cp(centipawns), board.turn), pv=[pv_move], nodes=nodes)
+                for pv_move, nodes, centipawns in fake_engine.search(board, num_nodes, multipv, rng)
+            ]
+            next_planes = encodings[i + 1].planes if i + 1 < len(encodings) else None
+            next_bitboards = v4.planes_to_bitboards(next_planes).tolist() if next_planes is not None else None
+            num_legal_moves = int(np.count_nonzero(~np.isnan(probs)))
+            positions.append(Position(
+                encoding,
+                game,
+                i,
+                probs,
+                board.copy(stack=False),
+                move,
+                lc0_move,
+                infos,
+                next_planes,
+                next_bitboards,
+                num_legal_moves,
+            ))
+            board.push(move)
+            board = board.mirror()
+    return Corpus(games, [gzip.compress(data) for data in games], num_game_positions, positions, num_nodes)
+
+
+# Each benchmark does its work over the whole corpus and returns how many positions that was
+
+def bench_parse_game(corpus):
+    for data in corpus.games:
+        for _ in rescore_logic.parse_game(data):
+            pass
+    return corpus.num_game_positions
+
+
+def bench_decode_game(corpus):
+    # The whole game codec score_file uses: map the game, batch check the policies, find every move played
+    for data in corpus.games:
+        v4.V4Game(data).unscored_moves()
+    return corpus.num_game_positions
+
+
+def bench_make_bitboards(corpus):
+    make_bitboards = rescore_logic.make_bitboards
+    for position in corpus.positions:
+        make_bitboards(position.encoding.planes)
+    return len(corpus.positions)
+
+
+def bench_game_bitboards(corpus):
+    for data in corpus.games:
+        v4.V4Game(data).piece_bitboards()
+    return corpus.num_game_positions
+
+
+def bench_is_single_probability_encoding(corpus):
+    is_single = rescore_logic._is_single_probability_encoding
+    for position in corpus.positions:
+        is_single(position.probs)
+    return len(corpus.positions)
+
+
+def bench_infer_move(corpus):
+    infer_move = rescore_logic._infer_move_from_planes_and_current_board
+    num_positions = 0
+    for position in corpus.positions:
+        if position.next_planes is not None:
+            infer_move(position.next_planes, position.board)
+            num_positions += 1
+    return num_positions
+
+
+def bench_infer_move_from_bitboards(corpus):
+    # What rescoring a game with a full policy does per position, given the bitboards of the whole game
+    infer_move = rescore_logic.infer_move
+    num_positions = 0
+    for position in corpus.positions:
+        if position.next_bitboards is not None:
+            infer_move(position.board, position.next_bitboards)
+            num_positions += 1
+    return num_positions
+
+
+def bench_q_and_probs_from_engine_score(corpus):
+    q_and_probs = rescore_logic.q_and_probs_from_engine_score
+    num_nodes = corpus.num_nodes
+    for position in corpus.positions:
+        q_and_probs(position.infos, position.probs, num_nodes, position.board, position.move)
+    return len(corpus.positions)
+
+
+def bench_clean_lc0_to_uci_move(corpus):
+    clean = rescore_logic.clean_lc0_to_uci_move
+    for position in corpus.positions:
+        clean(position.lc0_move, position.board)
+    return len(corpus.positions)
+
+
+def bench_unclean_uci_move_to_lc0(corpus):
+    unclean = rescore_logic.unclean_uci_move_to_lc0
+    for position in corpus.positions:
+        unclean(position.move.uci(), position.board)
+    return len(corpus.positions)
+
+
+def bench_move_from_policy_index(corpus):
+    move_from_policy_index = rescore_logic.move_from_policy_index
+    lookup = constants.MOVES_LOOKUP
+    for position in corpus.positions:
+        move_from_policy_index(lookup[position.lc0_move], position.board)
+    return len(corpus.positions)
+
+
+def bench_policy_index(corpus):
+    policy_index = rescore_logic.policy_index
+    for position in corpus.positions:
+        policy_index(position.move, position.board)
+    return len(corpus.positions)
+
+
+def bench_plan_search(corpus):
+    plan_search = search_plan.plan_search
+    num_nodes = corpus.num_nodes
+    for position in corpus.positions:
+        plan_search(position.board, num_nodes, position.num_legal_moves)
+    return len(corpus.positions)
+
+
+def bench_write_record(corpus):
+    # The in place write at the end of score_move, with the policy rewritten the way it is after scoring
+    for position in corpus.positions:
+        game = position.game
+        index = position.index
+        game.probs[index] = position.probs
+        game['root_q'][index] = 0.25
+        game['best_q'][index] = 0.25
+        game['root_d'][index] = constants.MOVES_LOOKUP[position.lc0_move]
+    return len(corpus.positions)
+
+
+def bench_score_move(corpus):
+    # Everything score_move does apart from waiting on the engine, planned from the record like score_file does
+    engine = RecordedEngine(corpus.positions)
+    num_nodes = corpus.num_nodes
+
+    async def score_all():
+        for position in corpus.positions:
+            await rescore_logic.score_move(
+                engine,
+                position.board,
+                position.game,
+                position.index,
+                num_nodes,
+                position.move,
+                plan=search_plan.plan_search(position.board, num_nodes, position.num_legal_moves),
+            )
+
+    asyncio.run(score_all())
+    return len(corpus.positions)
+
+
+def bench_score_file(corpus):
+    # A whole game at a time, decompressing and compressing included
+    engine = RecordedEngine(corpus.positions)
+    num_nodes = corpus.num_nodes
+
+    async def score_all():
+        for data in corpus.compressed_games:
+            await rescore_logic.score_file(data, engine, num_nodes)
+
+    asyncio.run(score_all())
+    return len(corpus.positions)
+
+
+BENCHMARKS = [
+    ('parse_game', bench_parse_game),
+    ('decode_game', bench_decode_game),
+    ('make_bitboards', bench_make_bitboards),
+    ('game_bitboards', bench_game_bitboards),
+    ('is_single_probability_encoding', bench_is_single_probability_encoding),
+    ('infer_move', bench_infer_move),
+    ('infer_move_from_bitboards', bench_infer_move_from_bitboards),
+    ('q_and_probs_from_engine_score', bench_q_and_probs_from_engine_score),
+    ('clean_lc0_to_uci_move', bench_clean_lc0_to_uci_move),
+    ('unclean_uci_move_to_lc0', bench_unclean_uci_move_to_lc0),
+    ('move_from_policy_index', bench_move_from_policy_index),
+    ('policy_index', bench_policy_index),
+    ('plan_search', bench_plan_search),
+    ('write_record', bench_write_record),
+    ('score_move', bench_score_move),
+    ('score_file', bench_score_file),
+]
+
+
+def time_benchmark(function, corpus, repeat):
+    """Best of repeat runs, in nanoseconds per position. Like timeit, the garbage collector is off while timing."""
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter_ns()
+            num_positions = function(corpus)
+            elapsed = time.perf_counter_ns() - start
+        finally:
+            gc.enable()
+        if best is None or elapsed / num_positions < best:
+            best = elapsed / num_positions
+    return best
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(path, results, args):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(
+            dict(
+                python=platform.python_version(),
+                numpy=np.__version__,
+                chess=chess.__version__,
+                machine=platform.machine(),
+                corpus=dict(games_folder=args.games_folder, num_games=args.num_games, seed=args.seed,
+                            num_nodes=args.num_nodes),
+                ns_per_position=results,
+            ),
+            f,
+            indent=2,
+            sort_keys=True,
+        )
+
+
+def main(args):
+    corpus = build_corpus(load_games(args.games_folder, args.num_games, args.seed), args.num_nodes, args.seed)
+    print(f'{len(corpus.games)} games, {corpus.num_game_positions} positions, {len(corpus.positions)} scored')
+    baseline = load_baseline(args.baseline_path)
+    baseline_results = baseline['ns_per_position'] if baseline else {}
+
+    results = {}
+    for name, function in BENCHMARKS:
+        if args.filter and args.filter not in name:
+            continue
+        results[name] = time_benchmark(function, corpus, args.repeat)
+        line = f'{name:32} {results[name]:12.0f} ns/position'
+        if name in baseline_results:
+            line += f'   baseline {baseline_results[name]:12.0f}  {baseline_results[name] / results[name]:5.2f}x'
+        print(line)
+
+    if args.save_baseline:
+        save_baseline(args.baseline_path, dict(baseline_results, **results), args)
+        print(f'saved baseline to {args.baseline_path}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-games', dest='num_games', type=int, default=20)
+    parser.add_argument('--seed', dest='seed', type=int, default=0)
+    parser.add_argument(
+        '--games-folder',
+        dest='games_folder',
+        default='',
+        help='use up to --num-games real .gz games from this folder as the corpus instead of synthetic ones'
+    )
+    parser.add_argument(
+        '--num-nodes',
+        dest='num_nodes',
+        type=int,
+        default=16,
+        help='nodes per position in the recorded engine output, which sets how many multipv lines there are'
+    )
+    parser.add_argument('--repeat', dest='repeat', type=int, default=5, help='report the best of this many runs')
+    parser.add_argument('--filter', dest='filter', default='', help='only run benchmarks with this in their name')
+    parser.add_argument(
+        '--baseline-path',
+        dest='baseline_path',
+        default=DEFAULT_BASELINE_PATH,
+        help='JSON file with results to compare against'
+    )
+    parser.add_argument(
+        '--save-baseline',
+        dest='save_baseline',
+        action='store_true',
+        help='write these results to --baseline-path, merged with what is there'
+    )
+    main(parser.parse_args())
@@ -0,0 +1,34 @@
+"""Scores games with whichever rescore_logic comes first on the path, for benchmarks.equivalence to record what an
+older tree wrote. Only uses what rescore_logic.score_file has taken since the first commit.
+
+    python -m benchmarks.reference_scores <games pickle> <output pickle> <num nodes>
+
+The games pickle is a list of uncompressed V4 games. The output pickle is {'dry': [...], 'engine': [...]}, each game
+scored without an engine and by fake_engine.InProcessEngine, uncompressed.
+"""
+import asyncio
+import gzip
+import pickle
+import sys
+
+from benchmarks import fake_engine
+import rescore_logic
+
+
+async def score_games(games, num_nodes):
+    outputs = dict(dry=[], engine=[])
+    engine = fake_engine.InProcessEngine()
+    for data in games:
+        compressed = gzip.compress(data)
+        outputs['dry'].append(gzip.decompress(await rescore_logic.score_file(compressed, None, num_nodes)))
+        outputs['engine'].append(gzip.decompress(await rescore_logic.score_file(compressed, engine, num_nodes)))
+    return outputs
+
+
+if __name__ == '__main__':
+    games_path, output_path, num_nodes = sys.argv[1:]
+    with open(games_path, 'rb') as f:
+        games = pickle.load(f)
+    outputs = asyncio.run(score_games(games, int(num_nodes)))
+    with open(output_path, 'wb') as f:
+        pickle.dump(outputs, f)
@@ -0,0 +1,112 @@
+import argparse
+import gzip
+import os
+import random
+import struct
+
+import chess
+import np
+
+import constants
+import rescore_logic
+
+
+def planes_for_board(board):
+    """The 832 plane bytes of a position, board being in the client's frame (side to move playing white).
+
+    Only the current position's 12 piece planes are filled in, history is left empty. They are laid out so that
+    rescore_logic.make_bitboards gives back board.mirror(), which is what move inference compares against after
+    pushing a move on the previous board.
+    """
+    target = board.mirror()
+    planes = bytearray(832)
+    for plane, symbol in enumerate(constants.PIECES):
+        # Upper case pieces are the side to move, which is black once the board is mirrored
+        color = chess.BLACK if symbol.isupper() else chess.WHITE
+        bitboard = target.pieces_mask(chess.PIECE_SYMBOLS.index(symbol.lower()), color)
+        for i in range(8):
+            planes[plane * 8 + i] = constants.BIT_REVERSE[(bitboard >> ((8 - i - 1) * 8)) & 0xFF]
+    return bytes(planes)
+
+
+def random_game(rng, max_plies=200, full_policy=False):
+    """An uncompressed V4 game of random legal moves, one position per ply, the way unscored training games look:
+    probability 1 on the move played, 0 on other legal moves, nan everywhere else. With full_policy, the legal moves
+    share a random policy instead, like selfplay or already scored games.
+
+    Like rescore_logic.score_file, the board is mirrored after every move so the side to move always plays white.
+    """
+    board = chess.Board()
+    positions = []
+    while len(positions) < max_plies and len(board.piece_map()) > 5 and not board.is_game_over():
+        legal_moves = list(board.legal_moves)
+        move = rng.choice(legal_moves)
+        probs = np.full(len(constants.MOVES), np.nan, dtype=np.float32)
+        for legal_move in legal_moves:
+            probs[rescore_logic.policy_index(legal_move, board)] = 0
+        probs[rescore_logic.policy_index(move, board)] = 1
+        if full_policy:
+            legal = ~np.isnan(probs)
+            weights = np.array([rng.random() for _ in range(len(legal_moves))], dtype=np.float32) + 0.01
+            probs[legal] = weights / weights.sum()
+        positions.append([
+            constants.VERSION4,
+            probs.tobytes(),
+            planes_for_board(board),
+            int(board.has_queenside_castling_rights(chess.WHITE)),
+            int(board.has_kingside_castling_rights(chess.WHITE)),
+            int(board.has_queenside_castling_rights(chess.BLACK)),
+            int(board.has_kingside_castling_rights(chess.BLACK)),
+            len(positions) % 2,
+            min(board.halfmove_clock, 255),
+            0,
+            0,
+            0.0,
+            0.0,
+            0.0,
+            0.0,
+        ])
+        board.push(move)
+        board = board.mirror()
+
+    # winner is from the point of view of the side to move, the side to move at the end lost if it's mated
+    if board.is_checkmate():
+        for ply, position in enumerate(reversed(positions)):
+            position[10] = 1 if ply % 2 == 0 else -1
+    return b''.join(struct.pack(constants.V4_STRUCT_STRING, *position) for position in positions)
+
+
+def write_games(output_dir, num_games, seed=0, max_plies=200, full_policy=False):
+    """Write num_games gzipped random games to output_dir, returns their paths. Same seed, same games."""
+    os.makedirs(output_dir, exist_ok=True)
+    rng = random.Random(seed)
+    paths = []
+    for i in range(num_games):
+        path = os.path.join(output_dir, f'synthetic-{seed}-{i:06d}.gz')
+        with open(path, 'wb') as f:
+            f.write(gzip.compress(random_game(rng, max_plies, full_policy)))
+        paths.append(path)
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output-folder', dest='output_folder', required=True)
+    parser.add_argument('--num-games', dest='num_games', type=int, default=100)
+    parser.add_argument('--seed', dest='seed', type=int, default=0)
+    parser.add_argument(
+        '--max-plies',
+        dest='max_plies',
+        type=int,
+        default=200,
+        help='stop each game after this many positions, if it hasn\'t ended or got down to 5 pieces before'
+    )
+    parser.add_argument(
+        '--full-policy',
+        dest='full_policy',
+        action='store_true',
+        help='give every legal move some policy, like selfplay or already scored games, instead of p=1 on the move '
+             'played'
+    )
+    args = parser.parse_args()
+    write_games(args.output_folder, args.num_games, args.seed, args.max_plies, args.full_policy)
@@ -0,0 +1,272 @@
+"""End to end throughput of game_server plus rescore_client on one box, with synthetic games and a fake engine.
+
+    python -m benchmarks.throughput --num-clients=4 --num-games=200 --engine-latency-ms=2
+
+Starts a game_server on the usual port (8888), so nothing else may be listening there. CPU time is read from /proc,
+so this is Linux only.
+"""
+import argparse
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks import synthetic_games
+import game_server
+import shards
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_PORT = 8888
+CLIENT_NAME = 'bench'
+
+
+def _clock_ticks():
+    return os.sysconf(os.sysconf_names['SC_CLK_TCK'])
+
+
+def process_table():
+    """{pid: (parent pid, cpu seconds so far)} for every process we can see."""
+    ticks = _clock_ticks()
+    table = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # The command name is in parens and may hold spaces, fields are counted from after it
+        fields = stat[stat.rindex(')') + 2:].split()
+        table[int(entry)] = (int(fields[1]), (int(fields[11]) + int(fields[12])) / ticks)
+    return table
+
+
+class CpuSampler:
+    """Last seen CPU seconds of the server, the clients and the clients' engines. Processes are sampled until they
+    exit, so up to one period of CPU per process is missed."""
+    def __init__(self, server_pid, client_pids):
+        self.server_pid = server_pid
+        self.client_pids = set(client_pids)
+        self.seconds = {}
+        self.roles = {server_pid: 'server'}
+        self.roles.update((pid, 'clients') for pid in client_pids)
+
+    def sample(self):
+        for pid, (parent_pid, cpu_seconds) in process_table().items():
+            if pid not in self.roles and parent_pid in self.client_pids:
+                self.roles[pid] = 'engines'
+            if pid in self.roles:
+                self.seconds[pid] = cpu_seconds
+
+    def by_role(self):
+        totals = dict(server=0.0, clients=0.0, engines=0.0)
+        for pid, cpu_seconds in self.seconds.items():
+            totals[self.roles[pid]] += cpu_seconds
+        return totals
+
+
+def wait_for_port(port, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'game_server did not start listening on {port} within {timeout}s')
+
+
+def count_output(output_dir):
+    """(games, positions) written so far, as one file per game or as members of finished shards."""
+    num_files = 0
+    num_positions = 0
+    for root, _, filenames in os.walk(output_dir):
+        for filename in filenames:
+            if filename.startswith('.'):
+                continue
+            path = os.path.join(root, filename)
+            if filename.endswith('.gz'):
+                with open(path, 'rb') as f:
+                    num_positions += game_server.game_positions(f.read())
+                num_files += 1
+            elif filename.endswith(shards.SHARD_SUFFIX + shards.INDEX_SUFFIX):
+                shard_path = path[:-len(shards.INDEX_SUFFIX)]
+                for offset, size in shards.load_index(path).values():
+                    num_positions += game_server.game_positions(shards.read_member(shard_path, offset, size))
+                    num_files += 1
+    return num_files, num_positions
+
+
+def write_engine_wrapper(directory):
+    """rescore_client takes a single engine path, so wrap the fake engine and this interpreter into one script."""
+    path = os.path.join(directory, 'fake_lc0')
+    with open(path, 'w') as f:
+        f.write(f'#!/bin/sh\nexec "{sys.executable}" "{os.path.join(REPO_DIR, "benchmarks", "fake_engine.py")}" "$@"\n')
+    os.chmod(path, 0o755)
+    return path
+
+
+def last_stage_breakdown(server_log_path):
+    breakdown = None
+    with open(server_log_path) as f:
+        for line in f:
+            match = re.match(rf'client {CLIENT_NAME} stages: (.*)', line)
+            if match:
+                breakdown = match.group(1)
+    return breakdown
+
+
+def run(args, work_dir):
+    input_dir = args.games_folder or os.path.join(work_dir, 'games')
+    if not args.games_folder:
+        synthetic_games.write_games(input_dir, args.num_games, args.seed, args.max_plies, args.full_policy)
+    num_games = sum(1 for _, _, filenames in os.walk(input_dir) for filename in filenames if filename.endswith('.gz'))
+    output_dir = os.path.join(work_dir, 'output')
+    engine_path = write_engine_wrapper(work_dir)
+
+    server_log_path = os.path.join(work_dir, 'server.log')
+    server_log = open(server_log_path, 'w')
+    server = subprocess.Popen(
+        [
+            sys.executable, 'game_server.py',
+            f'--input-folder={input_dir}',
+            f'--output-folder={output_dir}',
+            '--stats-period=1',
+        ] + args.server_args,
+        cwd=REPO_DIR,
+        stdout=server_log,
+        stderr=subprocess.STDOUT,
+    )
+    clients = []
+    try:
+        wait_for_port(SERVER_PORT, timeout=30)
+        env = dict(
+            os.environ,
+            FAKE_ENGINE_LATENCY_MS=str(args.engine_latency_ms),
+            FAKE_ENGINE_NODE_LATENCY_MS=str(args.node_latency_ms),
+        )
+        start = time.time()
+        for _ in range(args.num_clients):
+            clients.append(subprocess.Popen(
+                [
+                    sys.executable, 'rescore_client.py',
+                    f'--engine-path={engine_path}',
+                    '--weights-path=none',
+                    '--backend=fake',
+                    f'--client-name={CLIENT_NAME}',
+                    f'--port={SERVER_PORT}',
+                    f'--chunk-size={args.chunk_size}',
+                    f'--pipeline-depth={args.pipeline_depth}',
+                    f'--num-nodes={args.num_nodes}',
+                    '--stage-timing',
+                ] + (['--rescore-full-policies'] if args.full_policy else []) + args.client_args,
+                cwd=REPO_DIR,
+                env=env,
+                stdout=subprocess.DEVNULL,
+            ))
+        cpu = CpuSampler(server.pid, [client.pid for client in clients])
+        while any(client.poll() is None for client in clients):
+            cpu.sample()
+            time.sleep(0.5)
+        # Clients are done once they've uploaded, the server may still be writing
+        deadline = time.time() + 30
+        num_files, num_positions = count_output(output_dir)
+        while num_files < num_games and time.time() < deadline:
+            cpu.sample()
+            time.sleep(0.1)
+            num_files, num_positions = count_output(output_dir)
+        elapsed = time.time() - start
+        cpu.sample()
+    finally:
+        for process in clients + [server]:
+            if process.poll() is None:
+                process.terminate()
+        server.wait()
+        server_log.close()
+
+    failed = [client.returncode for client in clients if client.returncode]
+    cpu_seconds = cpu.by_role()
+    print(f'{args.num_clients} clients, {num_files}/{num_games} games, {num_positions} positions in {elapsed:.1f}s')
+    print(f'files/s {num_files / elapsed:.2f}  positions/s {num_positions / elapsed:.1f}')
+    print(
+        f'cpu seconds: server {cpu_seconds["server"]:.1f}  clients {cpu_seconds["clients"]:.1f}  '
+        f'engines {cpu_seconds["engines"]:.1f}  '
+        f'(server {100 * cpu_seconds["server"] / elapsed:.0f}% of a core)'
+    )
+    print(f'client stages: {last_stage_breakdown(server_log_path) or "none reported"}')
+    if failed:
+        print(f'{len(failed)} clients exited with errors {failed}, see {server_log_path} and rerun with --keep')
+    return num_files == num_games and not failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-clients', dest='num_clients', type=int, default=4)
+    parser.add_argument('--num-games', dest='num_games', type=int, default=200)
+    parser.add_argument(
+        '--games-folder',
+        dest='games_folder',
+        default='',
+        help='score the .gz games already in this folder instead of generating --num-games synthetic ones'
+    )
+    parser.add_argument('--seed', dest='seed', type=int, default=0)
+    parser.add_argument('--max-plies', dest='max_plies', type=int, default=200)
+    parser.add_argument(
+        '--full-policy',
+        dest='full_policy',
+        action='store_true',
+        help='generate games that already have a full policy and have the clients rescore them'
+    )
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=5)
+    parser.add_argument('--pipeline-depth', dest='pipeline_depth', type=int, default=2)
+    parser.add_argument('--num-nodes', dest='num_nodes', type=int, default=1)
+    parser.add_argument(
+        '--engine-latency-ms',
+        dest='engine_latency_ms',
+        type=float,
+        default=1,
+        help='time the fake engine takes for every position, standing in for a GPU round trip'
+    )
+    parser.add_argument(
+        '--node-latency-ms',
+        dest='node_latency_ms',
+        type=float,
+        default=0,
+        help='extra fake engine time per node searched'
+    )
+    parser.add_argument(
+        '--server-arg',
+        dest='server_args',
+        action='append',
+        default=[],
+        help='extra argument for game_server, e.g. --server-arg=--output-format=shards. Can be repeated'
+    )
+    parser.add_argument(
+        '--client-arg',
+        dest='client_args',
+        action='append',
+        default=[],
+        help='extra argument for every rescore_client, e.g. --client-arg=--engine-history. Can be repeated'
+    )
+    parser.add_argument(
+        '--keep',
+        dest='keep',
+        action='store_true',
+        help='keep the temporary folder with the games, output and server log'
+    )
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='leelenscorer-bench-')
+    try:
+        ok = run(args, work_dir)
+    finally:
+        if args.keep:
+            print(f'kept {work_dir}')
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    sys.exit(0 if ok else 1)
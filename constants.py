@@ -1908,3 +1908,43 @@ MOVES = [
 ]
 
 MOVES_LOOKUP = dict((move, i) for (i, move) in enumerate(MOVES))
+
+# MOVES as python-chess moves and back, so translating between them needs no move strings. lc0 spells two kinds of
+# moves like plain moves of another piece: knight promotions have no promotion letter, and castling is the king
+# taking its own rook. POLICY_MOVE_VARIANTS has (piece type, move) for those, the move they are when that piece
+# type is on the from square.
+POLICY_MOVES = [chess.Move.from_uci(move) for move in MOVES]
+POLICY_MOVE_VARIANTS = [None] * len(MOVES)
+for (i, move) in enumerate(POLICY_MOVES):
+    if move.promotion is None and chess.square_rank(move.from_square) == 6 and chess.square_rank(move.to_square) == 7:
+        POLICY_MOVE_VARIANTS[i] = (chess.PAWN, chess.Move(move.from_square, move.to_square, chess.KNIGHT))
+POLICY_MOVE_VARIANTS[MOVES_LOOKUP['e1h1']] = (chess.KING, chess.Move(chess.E1, chess.G1))
+POLICY_MOVE_VARIANTS[MOVES_LOOKUP['e1a1']] = (chess.KING, chess.Move(chess.E1, chess.C1))
+
+
+def policy_key(from_square, to_square, promotion):
+    return (promotion or 0) * 4096 + from_square * 64 + to_square
+
+
+# Index into MOVES by policy_key, castling aside. Knight promotions share the index of the plain move
+POLICY_INDEX = {}
+for (i, move) in enumerate(POLICY_MOVES):
+    POLICY_INDEX[policy_key(move.from_square, move.to_square, move.promotion)] = i
+for (i, variant) in enumerate(POLICY_MOVE_VARIANTS):
+    if variant is not None and variant[0] == chess.PAWN:
+        POLICY_INDEX[policy_key(variant[1].from_square, variant[1].to_square, variant[1].promotion)] = i
+# Index of the king's move from e1 to these squares when it castles
+CASTLING_POLICY_INDEX = {chess.G1: MOVES_LOOKUP['e1h1'], chess.C1: MOVES_LOOKUP['e1a1']}
+
+# The same moves for black to move: the policy is always from the side to move's point of view, so black's moves
+# are white's with the board flipped top to bottom, square ^ 56
+FLIPPED_POLICY_MOVES = [
+    chess.Move(chess.square_mirror(move.from_square), chess.square_mirror(move.to_square), move.promotion)
+    for move in POLICY_MOVES
+]
+FLIPPED_POLICY_MOVE_VARIANTS = [
+    None if variant is None else (variant[0], chess.Move(
+        chess.square_mirror(variant[1].from_square), chess.square_mirror(variant[1].to_square), variant[1].promotion
+    ))
+    for variant in POLICY_MOVE_VARIANTS
+]
@@ -1,25 +1,227 @@
-import asyncio
-import json
+"""Echoes games back to game_server without scoring them.
 
-from encoding import write_payload
+With no arguments, takes a single chunk and hands it straight back. With --clients it turns into a load generator:
+thousands of simulated clients in one process, stepped up through the given client counts, printing how fast the
+server hands out work at each step.
 
+    PYTHONPATH=. python debugging_utils/parrot_client.py --clients=100,1000,5000 --step-seconds=60 --think-seconds=2
 
-async def tcp_echo_client():
-    reader, writer = await asyncio.open_connection(
-        '127.0.0.1', 8888)
+Simulated clients think fast, so run the server with --max-chunk-size set to --chunk-size, otherwise its chunk
+sizing hands each of them far bigger chunks than a real client would get. The server also needs an open file
+limit above the number of clients.
+"""
+import argparse
+import asyncio
+from asyncio import IncompleteReadError
+import random
+import resource
 
-    write_payload(writer, [b'ready'])
-    await writer.drain()
+import encoding
 
-    write_payload(writer, [str(1).encode()])
+
+async def tcp_echo_client(host, port):
+    reader, writer = await asyncio.open_connection(host, port)
+
+    encoding.write_hello(writer)
+    encoding.write_message(writer, b'parrot 1 1')
     await writer.drain()
+    await encoding.read_message(reader)
 
-    data = await reader.read()
+    chunk_id, files = await encoding.read_chunk(reader)
 
-    write_payload(writer, [data])
+    encoding.write_chunk(writer, chunk_id, files)
+    encoding.write_report(writer, {})
     await writer.drain()
     print('calling back')
     writer.close()
     await writer.wait_closed()
 
-asyncio.run(tcp_echo_client())
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class StepStats:
+    def __init__(self):
+        self.connect_seconds = []
+        # Time from uploading results (or connecting) to the next chunk arriving, with --pipeline-depth=1 that's
+        # how long the server took to dispatch
+        self.dispatch_seconds = []
+        self.files_returned = 0
+        self.chunks_returned = 0
+        self.disconnects = 0
+        self.errors = 0
+        self.out_of_work = 0
+
+
+class LoadGenerator:
+    def __init__(self, args):
+        self.args = args
+        self.stats = StepStats()
+        self.stopping = False
+        self.rng = random.Random(args.seed)
+        self.upload = bytes(self.rng.getrandbits(8) for _ in range(args.upload_bytes))
+
+    async def _connect(self, name):
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        reader, writer = await asyncio.open_connection(self.args.host, self.args.port)
+        encoding.write_hello(writer)
+        encoding.write_message(writer, f'{name} {self.args.chunk_size} {self.args.pipeline_depth}'.encode())
+        await writer.drain()
+        await encoding.read_message(reader)
+        self.stats.connect_seconds.append(loop.time() - start)
+        return reader, writer
+
+    async def _session(self, name):
+        """One connection, until the server runs out of work (returns False) or we decide to drop it (True)."""
+        loop = asyncio.get_event_loop()
+        args = self.args
+        reader, writer = await self._connect(name)
+        try:
+            waiting_since = loop.time()
+            while not self.stopping:
+                chunk_id, files = await encoding.read_chunk(reader)
+                if not files:
+                    self.stats.out_of_work += 1
+                    return False
+                self.stats.dispatch_seconds.append(loop.time() - waiting_since)
+                if self.rng.random() < args.disconnect_rate:
+                    # Vanish without returning the chunk, the server has to release the lease
+                    self.stats.disconnects += 1
+                    return True
+
+                await asyncio.sleep(args.think_seconds * len(files) * self.rng.uniform(0.5, 1.5))
+                results = files if not self.upload else [self.upload] * len(files)
+                encoding.write_chunk(writer, chunk_id, results)
+                encoding.write_report(writer, {})
+                await writer.drain()
+                self.stats.files_returned += len(files)
+                self.stats.chunks_returned += 1
+                waiting_since = loop.time()
+            return False
+        finally:
+            writer.close()
+
+    async def simulated_client(self, index, start_delay):
+        await asyncio.sleep(start_delay)
+        name = f'{self.args.client_name}{index % self.args.num_names}'
+        while not self.stopping:
+            try:
+                if not await self._session(name):
+                    return
+            except (OSError, IncompleteReadError, encoding.ProtocolError):
+                self.stats.errors += 1
+                await asyncio.sleep(1)
+
+    def print_step(self, num_clients, seconds):
+        stats = self.stats
+        print(
+            f'{num_clients:7d} clients  files/s {stats.files_returned / seconds:9.1f}  '
+            f'chunks/s {stats.chunks_returned / seconds:8.1f}  '
+            f'dispatch ms p50 {1000 * percentile(stats.dispatch_seconds, 0.5):7.1f} '
+            f'p95 {1000 * percentile(stats.dispatch_seconds, 0.95):7.1f} '
+            f'p99 {1000 * percentile(stats.dispatch_seconds, 0.99):7.1f}  '
+            f'connect ms p50 {1000 * percentile(stats.connect_seconds, 0.5):7.1f} '
+            f'p99 {1000 * percentile(stats.connect_seconds, 0.99):7.1f}  '
+            f'disconnects {stats.disconnects}  errors {stats.errors}  out of work {stats.out_of_work}'
+        )
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        tasks = []
+        for num_clients in self.args.client_counts:
+            new_clients = num_clients - len(tasks)
+            for i in range(new_clients):
+                start_delay = self.args.ramp_seconds * i / max(new_clients, 1)
+                tasks.append(loop.create_task(self.simulated_client(len(tasks), start_delay)))
+            self.stats = StepStats()
+            await asyncio.sleep(self.args.step_seconds)
+            self.print_step(num_clients, self.args.step_seconds)
+            if all(task.done() for task in tasks):
+                print('every simulated client ran out of work, stopping')
+                break
+        self.stopping = True
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def raise_file_limit(num_connections):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = num_connections + 100
+    if soft < wanted:
+        new_soft = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (new_soft, hard))
+        if new_soft < wanted:
+            print(f'open file limit is {new_soft}, fewer than the {wanted} needed, expect connection errors')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', dest='host', default='127.0.0.1')
+    parser.add_argument('--port', dest='port', type=int, default=8888)
+    parser.add_argument(
+        '--clients',
+        dest='clients',
+        default='',
+        help='comma separated simulated client counts to step through, e.g. 100,1000,5000. Without it, parrot back '
+             'one chunk and exit'
+    )
+    parser.add_argument('--step-seconds', dest='step_seconds', type=float, default=30, help='time spent at each step')
+    parser.add_argument(
+        '--ramp-seconds',
+        dest='ramp_seconds',
+        type=float,
+        default=5,
+        help='spread the connections added at each step over this many seconds'
+    )
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=5)
+    parser.add_argument(
+        '--pipeline-depth',
+        dest='pipeline_depth',
+        type=int,
+        default=1,
+        help='chunks in flight per simulated client. At 1 the dispatch latency is purely server time'
+    )
+    parser.add_argument(
+        '--think-seconds',
+        dest='think_seconds',
+        type=float,
+        default=1,
+        help='average time a simulated client "scores" each file for, picked uniformly from 0.5x to 1.5x'
+    )
+    parser.add_argument(
+        '--disconnect-rate',
+        dest='disconnect_rate',
+        type=float,
+        default=0,
+        help='chance a simulated client drops its connection instead of returning a chunk, then reconnects'
+    )
+    parser.add_argument(
+        '--upload-bytes',
+        dest='upload_bytes',
+        type=int,
+        default=0,
+        help='send back this many random bytes per file instead of echoing the game'
+    )
+    parser.add_argument('--client-name', dest='client_name', default='parrot')
+    parser.add_argument(
+        '--num-names',
+        dest='num_names',
+        type=int,
+        default=10,
+        help='simulated clients share this many names, the way processes on one box share a client name'
+    )
+    parser.add_argument('--seed', dest='seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if not args.clients:
+        asyncio.run(tcp_echo_client(args.host, args.port))
+    else:
+        args.client_counts = [int(count) for count in args.clients.split(',')]
+        raise_file_limit(max(args.client_counts))
+        asyncio.run(LoadGenerator(args).run())
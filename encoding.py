@@ -1,16 +1,96 @@
-SEP = b'\n\n\n\n\n\n'
+import json
+import struct
 
+# Wire format between game_server and rescore_client. Every message is length-prefixed, so nothing ever has to scan
+# payload bytes for a separator and payload size is not bounded by the StreamReader limit.
+#
+#   message: MESSAGE_HEADER(length) + payload
+#   chunk:   CHUNK_HEADER(version, chunk_id, num_files, total_bytes) + num_files * FILE_LENGTH + payloads
+#
+#   report:  message holding a JSON object, sent by the client right after each result chunk
+#
+# A chunk with num_files == 0 tells the other side there is no more work coming.
+PROTOCOL_VERSION = 4
 
-def write_payload(writer, payload):
-    for line in payload:
-        writer.write(line)
-        writer.write(SEP)
+MESSAGE_HEADER = struct.Struct('!I')
+CHUNK_HEADER = struct.Struct('!BIII')
+FILE_LENGTH = struct.Struct('!I')
 
 
-def remove_sep(bytestring):
-    if not bytestring:
-        return bytestring
-    if bytestring[-1] == SEP[-1]:
-        return bytestring[:len(bytestring) - len(SEP)]
-    else:
-        return bytestring
+class ProtocolError(Exception):
+    pass
+
+
+def write_message(writer, payload):
+    writer.write(MESSAGE_HEADER.pack(len(payload)))
+    writer.write(payload)
+
+
+async def read_message(reader):
+    (length,) = MESSAGE_HEADER.unpack(await reader.readexactly(MESSAGE_HEADER.size))
+    return await reader.readexactly(length)
+
+
+def write_hello(writer):
+    write_message(writer, f'ready {PROTOCOL_VERSION}'.encode())
+
+
+async def read_hello(reader):
+    greeting, _, version = (await read_message(reader)).decode(errors='replace').partition(' ')
+    if greeting != 'ready' or not version.isdigit():
+        raise ProtocolError(f'bad hello from client: {greeting} {version}')
+    if int(version) != PROTOCOL_VERSION:
+        raise ProtocolError(f'client speaks protocol {version}, server speaks {PROTOCOL_VERSION}')
+
+
+def write_chunk(writer, chunk_id, files):
+    lengths = [len(f) for f in files]
+    header = bytearray(CHUNK_HEADER.size + FILE_LENGTH.size * len(files))
+    CHUNK_HEADER.pack_into(header, 0, PROTOCOL_VERSION, chunk_id, len(files), sum(lengths))
+    struct.pack_into(f'!{len(files)}I', header, CHUNK_HEADER.size, *lengths)
+    writer.write(header)
+    writer.writelines(files)
+
+
+def write_end_of_work(writer):
+    write_chunk(writer, 0, [])
+
+
+async def read_chunk(reader):
+    """Read one chunk written by write_chunk, returns (chunk_id, files). files is empty at end of work.
+
+    The whole chunk body is pulled off the socket with one readexactly and split up with a memoryview, so the
+    only per-file copy is the final bytes() conversion.
+    """
+    version, chunk_id, num_files, total_bytes = CHUNK_HEADER.unpack(await reader.readexactly(CHUNK_HEADER.size))
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f'got chunk with protocol version {version}, expected {PROTOCOL_VERSION}')
+    if not num_files:
+        return chunk_id, []
+
+    lengths = struct.unpack(f'!{num_files}I', await reader.readexactly(FILE_LENGTH.size * num_files))
+    if sum(lengths) != total_bytes:
+        raise ProtocolError(f'chunk {chunk_id} file lengths add up to {sum(lengths)}, header says {total_bytes}')
+
+    body = memoryview(await reader.readexactly(total_bytes))
+    files = []
+    offset = 0
+    for length in lengths:
+        files.append(bytes(body[offset:offset + length]))
+        offset += length
+    return chunk_id, files
+
+
+def write_report(writer, report):
+    write_message(writer, json.dumps(report, separators=(',', ':')).encode())
+
+
+async def read_report(reader):
+    """Read the report that follows every result chunk, a dict of whatever the client measured while scoring it."""
+    try:
+        report = json.loads((await read_message(reader)).decode())
+    except ValueError as e:
+        raise ProtocolError(f'bad report from client: {e}')
+    if not isinstance(report, dict):
+        raise ProtocolError(f'report should be a JSON object, got {type(report).__name__}')
+    return report
@@ -1,32 +1,54 @@
-import aiofiles
 import argparse
 import asyncio
 from asyncio import IncompleteReadError
-from collections import deque
+from collections import deque, namedtuple
 import datetime
+import itertools
+import math
+import struct
 import time
 import os
 
-from encoding import write_payload
+import constants
 import encoding
-
-
-def all_gzipped_files(scan_iter, filter_text, output_dir, input_dir, resume_mode):
-    for (dir, dirnames, filenames) in scan_iter:
-        if filter_text and filter_text not in dir:
-            continue
-        for filename in filenames:
-            if not filename.endswith('.gz'):
-                continue
-            filename_to_load = os.path.join(dir, filename)
-            if resume_mode:
-                outpath, _ = _get_full_output_filename(output_dir, input_dir, filename_to_load)
-                try:
-                    os.stat(outpath + os.sep + filename)
-                    continue
-                except:
-                    pass
-            yield filename_to_load
+import manifest
+import metrics
+import output_writer
+import profiling
+import rate_tracker
+import readahead
+import scanner
+import search_plan
+import shards
+import stage_timer
+
+
+def files_to_score(input_dir, filter_text, is_done, job_manifest):
+    """Blocking iterator of ScannedFile for everything that still needs scoring, meant to run in the scanner thread.
+
+    is_done is only passed in resume mode, and tells whether an input file's output is already written.
+    """
+    scanned = scanner.walk_gzipped_files(input_dir, filter_text)
+    if job_manifest is not None:
+        return manifest_files(job_manifest, scanned, is_done)
+    if is_done is not None:
+        return (f for f in scanned if not is_done(f.path))
+    return scanned
+
+
+def manifest_files(manifest, scan_iter, is_done, batch_size=1000):
+    # After one complete walk the manifest alone knows what's left to do
+    if manifest.scan_complete:
+        for path in manifest.pending_paths():
+            yield scanner.ScannedFile(path, None)
+        return
+    while True:
+        batch = dict((f.path, f) for f in itertools.islice(scan_iter, batch_size))
+        if not batch:
+            break
+        for path in manifest.add_scanned(batch, is_done):
+            yield batch[path]
+    manifest.mark_scan_complete()
 
 
 def _get_full_output_filename(output_dir, input_dir, filepath):
@@ -40,74 +62,332 @@ def _get_full_output_filename(output_dir, input_dir, filepath):
     return os.sep.join(dir_parts), filename
 
 
-async def load_files(filenames):
-    files = []
-    for filename in filenames:
-        async with aiofiles.open(filename, 'rb') as f:
-            bytestream = await f.read()
-            files.append(bytestream)
-    return files
-
-
-async def write_files_to_disk(output_dir, input_dir, filepaths, files):
-    for path, file in zip(filepaths, files):
-        if not file:
-            #TODO: some warning
-            continue
+def game_positions(data):
+    # The gzip trailer ends with the uncompressed size mod 2**32, plenty for one game, so no need to decompress
+    if len(data) < 4:
+        return 0
+    return struct.unpack('<I', data[-4:])[0] // constants.V4_BYTES
 
-        full_out_directory, filename = _get_full_output_filename(output_dir, input_dir, path)
-        os.makedirs(full_out_directory, exist_ok=True)
 
-        async with aiofiles.open(full_out_directory + os.sep + filename, 'wb') as f:
-            await f.write(file)
-            await f.close()
+def _get_output_path(output_dir, input_dir, filepath):
+    full_out_directory, filename = _get_full_output_filename(output_dir, input_dir, filepath)
+    return full_out_directory + os.sep + filename
 
 
 class ClientStats:
     def __init__(self):
         self.num_attached_clients = 0
-        # Format = [(timestamp, num_processed, time_taken), (timestamp, num_processed, time_taken)...]
-        self.processed_queue = deque(maxlen=100)
+        self.rates = rate_tracker.RateTracker()
         self.total_processed = 0
-
-    def compute_stats_for_client(self, last_n_seconds):
-        now = datetime.datetime.now()
-        cutoff_time = now - datetime.timedelta(seconds=last_n_seconds)
-
-        num_processed_in_timeframe = 0
-        for (timestamp, num_processed, time_taken) in self.processed_queue:
-            if timestamp < cutoff_time:
-                break
-            if timestamp - datetime.timedelta(seconds=time_taken) < cutoff_time:
-                # Have to apply discounting because not all files processed by this client were processed in last_n_seconds, so calculate roughly how many were using *math*
-                seconds_in_stats_window = timestamp - cutoff_time
-                # What percentage of time_taken is in period we care about
-                overlap_ratio = seconds_in_stats_window.total_seconds() / time_taken
-                effective_num_processed = num_processed * overlap_ratio
-                num_processed_in_timeframe += effective_num_processed
-            else:
-                num_processed_in_timeframe += num_processed
+        # Smoothed scoring time of one file on one process of this client, None until a chunk comes back
+        self.seconds_per_file = None
+        self.num_disconnects = 0
+        # Client-side seconds per scoring stage, summed over every report from clients run with --stage-timing
+        self.stage_seconds = {}
+        self.engine_calls = 0
+        # search_plan.SearchStats counts, summed over every report
+        self.search_counts = {}
+
+    def record_report(self, report):
+        for stage, seconds in report.get('seconds', {}).items():
+            self.stage_seconds[stage] = self.stage_seconds.get(stage, 0) + seconds
+        self.engine_calls += report.get('calls', {}).get('engine', 0)
+        for field, count in report.get('search', {}).items():
+            self.search_counts[field] = self.search_counts.get(field, 0) + count
+
+    def stage_breakdown(self):
+        total = sum(self.stage_seconds.values())
+        if not total:
+            return None
+        parts = [
+            f'{stage} {100 * self.stage_seconds[stage] / total:.0f}%'
+            for stage in stage_timer.STAGES if stage in self.stage_seconds
+        ]
+        if self.engine_calls:
+            parts.append(f'engine avg {1000 * self.stage_seconds.get("engine", 0) / self.engine_calls:.2f}ms')
+        return '  '.join(parts)
+
+    def compute_stats_for_client(self, window_seconds=60):
+        rates = self.rates.rates(window_seconds, time.time())
         return dict(
-            files_per_second=(num_processed_in_timeframe / last_n_seconds),
+            files_per_second=rates['files'],
+            positions_per_second=rates['positions'],
+            bytes_per_second=rates['bytes'],
             total_files=self.total_processed,
         )
 
 
+class ChunkSizer:
+    """Picks the size of the next chunk for one connection so that scoring it takes roughly target_seconds.
+
+    Starts from the rate ClientStats already learned for the client name (or the client's own --chunk-size for a
+    client we haven't seen), and the target is cut for clients that have dropped connections before, so flaky
+    boxes hold less work at any time.
+    """
+    SMOOTHING = 0.3
+
+    def __init__(self, client_stats, requested_size, target_seconds, min_size, max_size):
+        self.client_stats = client_stats
+        self.target_seconds = target_seconds
+        self.min_size = min_size
+        self.max_size = max_size
+        self.chunk_size = self._clamp(requested_size)
+        if self.target_seconds and client_stats.seconds_per_file:
+            self._resize()
+
+    def _clamp(self, size):
+        return max(self.min_size, min(self.max_size, int(size)))
+
+    def _resize(self):
+        target = self.target_seconds / (1 + self.client_stats.num_disconnects)
+        self.chunk_size = self._clamp(round(target / self.client_stats.seconds_per_file))
+
+    def record(self, num_processed, time_taken):
+        if not num_processed or time_taken <= 0:
+            return
+        sample = time_taken / num_processed
+        previous = self.client_stats.seconds_per_file
+        if previous is None:
+            self.client_stats.seconds_per_file = sample
+        else:
+            self.client_stats.seconds_per_file = previous + self.SMOOTHING * (sample - previous)
+        if self.target_seconds:
+            self._resize()
+
+
+def rate_share(client_stats, fleet):
+    """Fraction of what every connected client process scores per second that one process of client_stats scores.
+    Split evenly by process until every connected client has a measured rate."""
+    connected = [stats for stats in fleet if stats.num_attached_clients]
+    if client_stats.seconds_per_file and all(stats.seconds_per_file for stats in connected):
+        fleet_rate = sum(stats.num_attached_clients / stats.seconds_per_file for stats in connected)
+        return 1 / client_stats.seconds_per_file / fleet_rate
+    return 1 / max(1, sum(stats.num_attached_clients for stats in connected))
+
+
+def tail_chunk_size(chunk_size, remaining, share, window):
+    """Cuts a chunk near the end of the job to this connection's share of the files left, spread over the chunks
+    it keeps in flight, so the last files go to every client in proportion to its speed instead of landing on
+    whichever one asks first. remaining is None while it isn't known yet."""
+    if remaining is None:
+        return chunk_size
+    return max(1, min(chunk_size, math.ceil(remaining * share / window)))
+
+
+Lease = namedtuple('Lease', ['chunk_id', 'filenames', 'connection_id', 'deadline'])
+
+
+class LeaseTable:
+    """Tracks every chunk handed out until its results come back.
+
+    A lease is given back (its files go to the front of the retry queue) when the connection holding it drops or
+    when it runs past its deadline. Results for a lease that was already given back are thrown away, the files are
+    scored again by whoever picks them up from the retry queue, so each file is only ever written once.
+    """
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.active = {}
+        self.retry_queue = deque()
+        self.num_expired = 0
+        self.num_released = 0
+
+    def grant(self, chunk_id, filenames, connection_id, expected_seconds):
+        deadline = time.time() + max(self.timeout, 3 * expected_seconds)
+        self.active[chunk_id] = Lease(chunk_id, filenames, connection_id, deadline)
+
+    def complete(self, chunk_id):
+        return self.active.pop(chunk_id, None)
+
+    def _requeue(self, lease):
+        del self.active[lease.chunk_id]
+        self.retry_queue.extendleft(reversed(lease.filenames))
+
+    def release_connection(self, connection_id):
+        released = [l for l in self.active.values() if l.connection_id == connection_id]
+        for lease in released:
+            self._requeue(lease)
+            self.num_released += 1
+        return released
+
+    def expire(self, now):
+        expired = [l for l in self.active.values() if l.deadline < now]
+        for lease in expired:
+            self._requeue(lease)
+            self.num_expired += 1
+        return expired
+
+    def requeue_files(self, filenames):
+        """Files whose lease already completed but whose results were lost after all, like a failed write."""
+        self.retry_queue.extendleft(reversed(filenames))
+
+    def take_retries(self, max_files):
+        filenames = []
+        while self.retry_queue and len(filenames) < max_files:
+            filenames.append(self.retry_queue.popleft())
+        return filenames
+
 
 class DirectoryQueue:
-    def __init__(self, input_dir, output_dir, filter_text, resume_mode):
+    def __init__(self, input_dir, output_dir, filter_text, resume_mode, max_window, chunk_sizing, lease_timeout,
+                 job_manifest=None, scan_queue_size=10000, readahead_limits=(512 * 1024 * 1024, 2000, 8),
+                 writer_settings=(4, 64), sink=None):
         self.input_dir = input_dir
         self.output_dir = output_dir
         self.filter_text = filter_text
-        self.scan_iter = all_gzipped_files(os.walk(input_dir), filter_text, output_dir, input_dir, resume_mode)
+        self.job_manifest = job_manifest
+        if sink is None:
+            sink = output_writer.FileSink(lambda path: _get_output_path(output_dir, input_dir, path), 'file')
+        self.scanner = scanner.DirectoryScanner(
+            files_to_score(input_dir, filter_text, sink.done_checker() if resume_mode else None, job_manifest),
+            scan_queue_size,
+        )
+        self.metrics = metrics.Registry(prefix='leelenscorer_')
+        self._register_metrics()
+        # (max_bytes, max_files, concurrency)
+        self.readahead = readahead.ReadAhead(
+            self.scanner,
+            *readahead_limits,
+            latency_histogram=self.metrics.histogram('disk_read_seconds', 'Time to read one input game'),
+            on_failed=self._read_failed,
+        )
+        # (num_workers, queue_size)
+        self.output_writer = output_writer.OutputWriter(
+            sink,
+            *writer_settings,
+            on_written=self._written,
+            on_failed=self._write_failed,
+            latency_histogram=self.metrics.histogram('disk_write_seconds', 'Time to write one chunk of results'),
+        )
         self.resume_mode = resume_mode
+        self.max_window = max_window
+        # (target_seconds, min_size, max_size) handed to every ChunkSizer
+        self.chunk_sizing = chunk_sizing
         self.total_processed = 0
+        self.chunks_dispatched = 0
+        self.connections_opened = 0
+        self.job_finished = False
+        # Senders reading requeued files that are out of the retry queue but not leased yet
+        self.num_loading = 0
         self.client_tracker = {}
-
-    def track_stats(self, num_processed, time_taken, timestamp, client_name):
+        # Every client together, so fleet rates don't have to add up hundreds of trackers
+        self.fleet_rates = rate_tracker.RateTracker()
+        self.leases = LeaseTable(lease_timeout)
+
+    def _register_metrics(self):
+        m = self.metrics
+        self.files_scored = m.counter('files_scored_total', 'Scored games returned', ['client'])
+        self.positions_scored = m.counter('positions_scored_total', 'Positions in scored games returned', ['client'])
+        self.bytes_sent = m.counter('bytes_sent_total', 'Game bytes sent to clients', ['client'])
+        self.bytes_received = m.counter('bytes_received_total', 'Scored game bytes received from clients', ['client'])
+        self.chunk_round_trip = m.histogram(
+            'chunk_round_trip_seconds',
+            'Time from sending a chunk to getting its results back, including time queued on the client',
+            ['client'],
+        )
+        self.stage_seconds = m.counter(
+            'client_stage_seconds_total',
+            'Seconds clients spent in each stage of scoring, from clients run with --stage-timing',
+            ['client', 'stage'],
+        )
+        self.engine_latency = m.histogram(
+            'engine_latency_seconds',
+            'Time of a single engine analyse call on clients run with --stage-timing',
+            ['client'],
+            buckets=stage_timer.ENGINE_LATENCY_BUCKETS,
+        )
+        self.search_counts = m.counter(
+            'client_search_total',
+            'Games, positions, engine calls and nodes clients searched, and the engine calls, nodes and MultiPV '
+            'lines their search planner saved',
+            ['client', 'field'],
+        )
+        self.peak_chunk_memory = m.gauge(
+            'client_peak_chunk_memory_bytes',
+            'Peak python memory while scoring the last chunk, from clients run with --track-memory',
+            ['client'],
+        )
+        self.lease_expirations = m.counter('lease_expirations_total', 'Leases given back for running past deadline')
+        self.lease_releases = m.counter('lease_releases_total', 'Leases given back because the connection dropped')
+        self.read_failures = m.counter('read_failures_total', 'Input games that could not be read and were skipped')
+        for field in rate_tracker.DEFAULT_FIELDS:
+            m.gauge(
+                f'client_{field}_per_second',
+                f'Scored {field} per second each client returned, over several windows',
+                ['client', 'window'],
+                function=lambda field=field: self._client_rates(field),
+            )
+            m.gauge(
+                f'fleet_{field}_per_second',
+                f'Scored {field} per second returned by all clients together, over several windows',
+                ['window'],
+                function=lambda field=field: dict(
+                    ((f'{window}s',), self.fleet_rates.rates(window, time.time())[field])
+                    for window in rate_tracker.DEFAULT_WINDOWS
+                ),
+            )
+        m.gauge(
+            'client_nodes_per_position',
+            'Average nodes clients actually searched per scored position, first passes of --adaptive-nodes included',
+            ['client'],
+            function=lambda: dict(
+                ((name,), search_plan.nodes_per_position(stats.search_counts))
+                for name, stats in self.client_tracker.items() if stats.search_counts.get('positions')
+            ),
+        )
+        m.gauge(
+            'client_processes',
+            'Connected processes per client name',
+            ['client'],
+            function=lambda: dict(((name,), stats.num_attached_clients) for name, stats in self.client_tracker.items()),
+        )
+        m.gauge(
+            'queue_depth',
+            'Work waiting at each stage of the server',
+            ['stage'],
+            function=lambda: {
+                ('scanned',): self.scanner.num_ready,
+                ('read_ahead',): len(self.readahead.ready),
+                ('retry',): len(self.leases.retry_queue),
+                ('leased',): len(self.leases.active),
+                ('write',): self.output_writer.queue.qsize(),
+            },
+        )
+        m.gauge('read_ahead_bytes', 'Bytes of input held in memory', function=lambda: {(): self.readahead.bytes_held})
+
+    def record_report(self, client_name, report):
+        self.client_tracker[client_name].record_report(report)
+        for stage, seconds in report.get('seconds', {}).items():
+            self.stage_seconds.inc(seconds, client_name, stage)
+        for field, count in report.get('search', {}).items():
+            if count:
+                self.search_counts.inc(count, client_name, field)
+        if 'peak_memory_bytes' in report:
+            self.peak_chunk_memory.set(report['peak_memory_bytes'], client_name)
+        engine_latency = report.get('engine_latency')
+        if engine_latency and any(engine_latency['counts']):
+            try:
+                self.engine_latency.merge(
+                    engine_latency['buckets'],
+                    engine_latency['counts'],
+                    engine_latency['sum'],
+                    client_name,
+                )
+            except ValueError as e:
+                print(f'{client_name} sent unusable engine latencies: {e}')
+
+    def _client_rates(self, field):
+        now = time.time()
+        rates = {}
+        for name, stats in self.client_tracker.items():
+            for window in rate_tracker.DEFAULT_WINDOWS:
+                rates[(name, f'{window}s')] = stats.rates.rates(window, now)[field]
+        return rates
+
+    def track_stats(self, num_processed, num_positions, num_bytes, time_taken, timestamp, client_name):
         tracker = self.client_tracker[client_name]
         tracker.total_processed += num_processed
-        tracker.processed_queue.appendleft((timestamp, num_processed, time_taken))
+        for rates in (tracker.rates, self.fleet_rates):
+            rates.record(timestamp, time_taken, files=num_processed, positions=num_positions, bytes=num_bytes)
 
     def register_client(self, client_name):
         if client_name not in self.client_tracker:
@@ -116,86 +396,278 @@ class DirectoryQueue:
 
     async def print_stats(self, stats_period):
         while True:
-            computed_rate = 0
             for client_name, client_stats in self.client_tracker.items():
-                stats = client_stats.compute_stats_for_client(last_n_seconds=stats_period)
-                if not stats:
-                    continue
-                print(f'client {client_name}: procs {client_stats.num_attached_clients} files {stats["total_files"]}  rate {stats["files_per_second"]:.2f}')
-                computed_rate += stats["files_per_second"]
-            print(f'total {self.total_processed}  rate {computed_rate:.2f}')
+                stats = client_stats.compute_stats_for_client(window_seconds=60)
+                print(f'client {client_name}: procs {client_stats.num_attached_clients} files {stats["total_files"]}  rate {stats["files_per_second"]:.2f}  pos/s {stats["positions_per_second"]:.0f}  sec/file {client_stats.seconds_per_file or 0:.2f}')
+                breakdown = client_stats.stage_breakdown()
+                if breakdown is not None:
+                    print(f'client {client_name} stages: {breakdown}')
+                if client_stats.search_counts.get('games'):
+                    print(f'client {client_name} search: {search_plan.summarize(client_stats.search_counts)}')
+            now = time.time()
+            fleet = dict((window, self.fleet_rates.rates(window, now)) for window in rate_tracker.DEFAULT_WINDOWS)
+            computed_rate = fleet[60]['files']
+            print(f'fleet files/s 1m {fleet[60]["files"]:.2f} 5m {fleet[300]["files"]:.2f} 1h {fleet[3600]["files"]:.2f}  '
+                  f'pos/s 1m {fleet[60]["positions"]:.0f} 5m {fleet[300]["positions"]:.0f} 1h {fleet[3600]["positions"]:.0f}')
+            print(f'total {self.total_processed}  rate {computed_rate:.2f}  leased {len(self.leases.active)}  '
+                  f'retry {len(self.leases.retry_queue)}  scanned {self.scanner.num_ready} ready '
+                  f'{self.scanner.num_scanned} total  loaded {len(self.readahead.ready)} files '
+                  f'{self.readahead.bytes_held / 1e6:.1f}MB  writes queued {self.output_writer.queue.qsize()}  '
+                  f'expired {self.leases.num_expired}  '
+                  f'released {self.leases.num_released}')
+            if self.job_manifest is not None:
+                # ETA from the 5 minute rate, less jumpy than the last minute
+                self.print_progress(fleet[300]['files'])
             await asyncio.sleep(stats_period)
 
-    async def handle_new_client(self, reader, writer):
-        # Check it's a valid connection and client is ready
-        start_message = await reader.readuntil(encoding.SEP)
-        assert encoding.remove_sep(start_message) == b'ready', start_message
-
-        client_identification_message = encoding.remove_sep(await reader.readuntil(encoding.SEP))
-        client_name, client_set_chunk_size_str = client_identification_message.decode().split(' ')
-        client_set_chunk_size = int(client_set_chunk_size_str)
-
-        # Find some files to give the client
-        print(f'new client: {client_name} chunksize {client_set_chunk_size}')
-        self.register_client(client_name)
-        effective_chunk_size = client_set_chunk_size
-
+    def print_progress(self, files_per_second):
+        progress = self.job_manifest.progress()
+        if not self.job_manifest.scan_complete:
+            print(f'job: done {progress["done"]} of {progress["total"]} found so far, still scanning input')
+            return
+        remaining = progress['pending'] + progress['leased']
+        eta = 'unknown'
+        if files_per_second > 0:
+            eta = str(datetime.timedelta(seconds=int(remaining / files_per_second)))
+        percent_done = 100 * progress['done'] / max(progress['total'], 1)
+        print(f'job: done {progress["done"]} of {progress["total"]} ({percent_done:.1f}%)  '
+              f'pending {progress["pending"]}  leased {progress["leased"]}  failed {progress["failed"]}  eta {eta}')
+
+    def _read_failed(self, filenames):
+        self.read_failures.inc(len(filenames))
+        if self.job_manifest is not None:
+            self.job_manifest.mark_failed(filenames)
+
+    def _written(self, filenames):
+        if self.job_manifest is not None:
+            self.job_manifest.mark_done(filenames)
+
+    def _write_failed(self, filenames):
+        # Back to the front of the retry queue, and pending in the manifest until they are written
+        self.leases.requeue_files(filenames)
+        if self.job_manifest is not None:
+            self.job_manifest.mark_pending(filenames)
+
+    def _requeued(self, leases):
+        if self.job_manifest is not None:
+            for lease in leases:
+                self.job_manifest.mark_pending(lease.filenames)
+
+    async def expire_leases(self, period):
+        while True:
+            await asyncio.sleep(period)
+            expired = self.leases.expire(time.time())
+            self.lease_expirations.inc(len(expired))
+            for lease in expired:
+                print(f'lease on chunk {lease.chunk_id} expired, requeueing {len(lease.filenames)} files')
+            self._requeued(expired)
+
+    async def _next_work(self, chunk_size):
+        """Returns (filenames, files) loaded and ready to send, both empty when there is nothing to hand out."""
+        # Work given back by dead or stuck clients goes out before anything new. It has to be read again, everything
+        # else was already loaded by the read-ahead
+        while self.leases.retry_queue:
+            filenames = self.leases.take_retries(chunk_size)
+            self.num_loading += 1
+            try:
+                loaded = await self.readahead.load(filenames)
+            except asyncio.CancelledError:
+                # Connection closed mid-read, the files go back for the next sender
+                self.leases.requeue_files(filenames)
+                raise
+            finally:
+                self.num_loading -= 1
+            # Unreadable files were skipped, keep going if that was all of them
+            if loaded:
+                break
+        else:
+            loaded = await self.readahead.take(chunk_size)
+        return [path for path, _ in loaded], [data for _, data in loaded]
+
+    def _chunk_size(self, chunk_sizer, window):
+        remaining = None
+        # Only known once the scan is over, until then more files may turn up
+        if self.scanner.finished:
+            remaining = len(self.leases.retry_queue) + self.readahead.files_held + self.scanner.num_ready
+        share = rate_share(chunk_sizer.client_stats, self.client_tracker.values())
+        return tail_chunk_size(chunk_sizer.chunk_size, remaining, share, window)
+
+    async def _send_chunks(self, writer, client_name, connection_id, chunk_sizer, window, free_slots, in_flight):
         while True:
-            filenames = []
-            start = time.time()
-            for i, filepath in enumerate(self.scan_iter):
-                filenames.append(filepath)
-                if i == effective_chunk_size - 1:
-                    break
+            await free_slots.acquire()
+            filenames, files = await self._next_work(self._chunk_size(chunk_sizer, window))
+            # Nothing new to hand out, but outstanding leases elsewhere may still be given back, and writes that fail
+            # go back in the retry queue
+            while not filenames and (self.leases.active or self.output_writer.num_pending or self.num_loading):
+                await asyncio.sleep(1)
+                filenames, files = await self._next_work(self._chunk_size(chunk_sizer, window))
 
             # Current files have been exhausted, good job
             if not filenames:
-                print('closing conn because all done')
-                writer.write_eof()
+                encoding.write_end_of_work(writer)
                 await writer.drain()
-                writer.close()
-                await writer.wait_closed()
+                await in_flight.put(None)
+                if not self.job_finished:
+                    self.job_finished = True
+                    print('all work handed out and returned, flushing output')
+                    # Own task, this sender gets cancelled as soon as its connection closes
+                    asyncio.get_event_loop().create_task(self.output_writer.finish())
                 return
 
-            # Read out the files to pass to client
-            files = await load_files(filenames)
-            write_payload(writer, files)
-            if len(filenames) < effective_chunk_size:
-                # Loaded less than CHUNK_SIZE files, means we're out of files to load, aka we're done!
-                writer.write_eof()
+            self.chunks_dispatched += 1
+            chunk_id = self.chunks_dispatched
+            seconds_per_file = chunk_sizer.client_stats.seconds_per_file or 0
+            self.leases.grant(chunk_id, filenames, connection_id, len(filenames) * seconds_per_file * window)
+            if self.job_manifest is not None:
+                self.job_manifest.mark_leased(filenames)
+
+            encoding.write_chunk(writer, chunk_id, files)
+            self.bytes_sent.inc(sum(len(f) for f in files), client_name)
+            await in_flight.put((chunk_id, filenames, time.time()))
             await writer.drain()
 
-            file_outputs = []
-            for _ in filenames:
-                try:
-                    file_output = encoding.remove_sep(await reader.readuntil(encoding.SEP))
-                    if not file_output:
-                        break
-                    file_outputs.append(file_output)
-                except IncompleteReadError:
-                    tracker = self.client_tracker.get(client_name)
-                    # TODO: probably put requeueing broken jobs right here
-                    if tracker is not None:
-                        tracker.num_attached_clients -= 1
-                    return
+    async def _receive_results(self, reader, client_name, chunk_sizer, free_slots, in_flight):
+        # Chunks are scored in the order they were sent, so results come back in in_flight order
+        last_result_time = time.time()
+        while True:
+            sent = await in_flight.get()
+            if sent is None:
+                return
+            chunk_id, filenames, sent_time = sent
+
+            returned_chunk_id, file_outputs = await encoding.read_chunk(reader)
+            self.chunk_round_trip.observe(time.time() - sent_time, client_name)
+            self.record_report(client_name, await encoding.read_report(reader))
+            num_bytes = sum(len(f) for f in file_outputs)
+            self.bytes_received.inc(num_bytes, client_name)
+            assert returned_chunk_id == chunk_id, (returned_chunk_id, chunk_id)
+            assert len(file_outputs) == len(filenames), (len(file_outputs), len(filenames))
+            free_slots.release()
             # TODO: Do some sanity checking on these files to make sure they're roughly the right size.
+            if self.leases.complete(chunk_id) is None:
+                print(f'{client_name} returned chunk {chunk_id} after its lease was given back, dropping it')
+                continue
 
+            # With several chunks queued on the client, time since the previous result is the time spent scoring this one
+            now = time.time()
+            chunk_sizer.record(len(filenames), now - last_result_time)
+            num_positions = sum(game_positions(f) for f in file_outputs)
             self.track_stats(
                 num_processed=len(filenames),
-                time_taken=time.time() - start,
-                timestamp=datetime.datetime.now(),
+                num_positions=num_positions,
+                num_bytes=num_bytes,
+                time_taken=now - last_result_time,
+                timestamp=now,
                 client_name=client_name,
             )
+            last_result_time = now
             self.total_processed += len(filenames)
-            await write_files_to_disk(self.output_dir, self.input_dir, filenames, file_outputs)
+            self.files_scored.inc(len(filenames), client_name)
+            self.positions_scored.inc(num_positions, client_name)
+            empty = [filename for filename, data in zip(filenames, file_outputs) if not data]
+            if empty:
+                # A client only sends nothing back for a game it couldn't score, so retrying it straight away would
+                # likely go round forever. Pending in the manifest, so the next run tries it again.
+                print(f'{client_name} sent back {len(empty)} empty results in chunk {chunk_id}, leaving them pending')
+                if self.job_manifest is not None:
+                    self.job_manifest.mark_pending(empty)
+            # Only blocks when the writer is backed up
+            await self.output_writer.submit(filenames, file_outputs)
+
+    async def _read_handshake(self, reader, writer):
+        """(client name, chunk size it asked for, window granted), after checking it's a client that's ready."""
+        await encoding.read_hello(reader)
+        client_identification_message = await encoding.read_message(reader)
+        try:
+            client_name, client_set_chunk_size_str, client_window_str = \
+                client_identification_message.decode(errors='replace').split(' ')
+            client_set_chunk_size = int(client_set_chunk_size_str)
+            window = max(1, min(int(client_window_str), self.max_window))
+        except ValueError:
+            raise encoding.ProtocolError(f'bad client identification: {client_identification_message[:100]!r}')
+        encoding.write_message(writer, str(window).encode())
+        await writer.drain()
+        return client_name, client_set_chunk_size, window
+
+    async def handle_new_client(self, reader, writer):
+        client_name = None
+        sender = None
+        connection_id = None
+        try:
+            client_name, client_set_chunk_size, window = await self._read_handshake(reader, writer)
+
+            # Find some files to give the client
+            print(f'new client: {client_name} chunksize {client_set_chunk_size} window {window}')
+            self.register_client(client_name)
+            chunk_sizer = ChunkSizer(self.client_tracker[client_name], client_set_chunk_size, *self.chunk_sizing)
+
+            self.connections_opened += 1
+            connection_id = self.connections_opened
+            free_slots = asyncio.Semaphore(window)
+            in_flight = asyncio.Queue()
+            sender = asyncio.get_event_loop().create_task(
+                self._send_chunks(writer, client_name, connection_id, chunk_sizer, window, free_slots, in_flight)
+            )
+            await self._receive_results(reader, client_name, chunk_sizer, free_slots, in_flight)
+            print('closing conn because all done')
+        except (IncompleteReadError, ConnectionError, encoding.ProtocolError) as e:
+            if client_name is None:
+                # Port probes and anything else that isn't a client end up here
+                print(f'dropped connection before its handshake finished: {e!r}')
+            else:
+                self.client_tracker[client_name].num_disconnects += 1
+            return
+        finally:
+            if sender is not None:
+                sender.cancel()
+                try:
+                    await sender
+                except (asyncio.CancelledError, ConnectionError):
+                    pass
+            if connection_id is not None:
+                # Anything this connection still holds goes to the front of the retry queue
+                released = self.leases.release_connection(connection_id)
+                self.lease_releases.inc(len(released))
+                self._requeued(released)
+                self.client_tracker[client_name].num_attached_clients -= 1
+            writer.close()
+
+        await writer.wait_closed()
+
+
+def make_sink(args):
+    if args.output_format == 'shards':
+        return shards.ShardSink(
+            args.output_folder,
+            args.input_folder,
+            args.shard_mb * 1024 * 1024,
+            args.shard_max_age,
+            args.fsync,
+        )
+    return output_writer.FileSink(
+        lambda path: _get_output_path(args.output_folder, args.input_folder, path),
+        args.fsync,
+    )
 
 
 async def main(args):
+    job_manifest = None
+    if args.manifest_path:
+        job_manifest = manifest.JobManifest(args.manifest_path)
+        print(f'loaded manifest {args.manifest_path}: {job_manifest.progress()}')
     directory_queue = DirectoryQueue(
         args.input_folder,
         args.output_folder,
         args.filter_text,
-        args.resume_mode
+        args.resume_mode,
+        args.max_window,
+        (args.target_chunk_seconds, args.min_chunk_size, args.max_chunk_size),
+        args.lease_timeout,
+        job_manifest,
+        args.scan_queue_size,
+        (args.readahead_mb * 1024 * 1024, args.readahead_files, args.read_concurrency),
+        (args.writer_threads, args.write_queue_size),
+        make_sink(args),
     )
     server = await asyncio.start_server(
         directory_queue.handle_new_client,
@@ -203,8 +675,18 @@ async def main(args):
         8888,
     )
 
+    profiling.install_sampling_signal(args.profile_seconds, args.profile_dir)
+
+    if args.metrics_port:
+        await metrics.serve_metrics(directory_queue.metrics, args.metrics_host, args.metrics_port)
+        print(f'serving metrics on http://{args.metrics_host}:{args.metrics_port}/metrics')
+
     loop = asyncio.get_event_loop()
+    directory_queue.scanner.start(loop)
+    directory_queue.readahead.start(loop)
+    directory_queue.output_writer.start(loop)
     loop.create_task(directory_queue.print_stats(args.stats_period))
+    loop.create_task(directory_queue.expire_leases(period=5))
 
     async with server:
         await server.serve_forever()
@@ -244,5 +726,152 @@ if __name__ == '__main__' :
         default=False,
         help='Pass this if in you expect a lot of work to already be done in output_dir, will turn on checking output_dir first before yielding files to clients'
     )
+    parser.add_argument(
+        '--max-window',
+        dest='max_window',
+        type=int,
+        default=4,
+        help='Most chunks a single client may have in flight at once. Clients ask for a window with --pipeline-depth '
+             'and get at most this many'
+    )
+    parser.add_argument(
+        '--target-chunk-seconds',
+        dest='target_chunk_seconds',
+        type=float,
+        default=60,
+        help='Resize each client\'s chunks from its measured rate so one chunk takes about this long to score. '
+             'Pass 0 to always use the chunk size the client asked for'
+    )
+    parser.add_argument(
+        '--min-chunk-size',
+        dest='min_chunk_size',
+        type=int,
+        default=1,
+        help='Smallest chunk ever handed to a client'
+    )
+    parser.add_argument(
+        '--max-chunk-size',
+        dest='max_chunk_size',
+        type=int,
+        default=500,
+        help='Largest chunk ever handed to a client'
+    )
+    parser.add_argument(
+        '--lease-timeout',
+        dest='lease_timeout',
+        type=float,
+        default=600,
+        help='Seconds a client gets to return a chunk before its files are handed to someone else. Stretched for '
+             'clients whose measured rate says the chunk needs longer'
+    )
+    parser.add_argument(
+        '--manifest-path',
+        dest='manifest_path',
+        default='',
+        help='SQLite file recording pending/leased/done state of every input file. The first run fills it while '
+             'scanning, later runs resume from it without walking the input or stat()-ing the output. Keep it next '
+             'to the output folder and reuse it for the whole job'
+    )
+    parser.add_argument(
+        '--scan-queue-size',
+        dest='scan_queue_size',
+        type=int,
+        default=10000,
+        help='How many scanned paths the background directory scanner may get ahead of the clients'
+    )
+    parser.add_argument(
+        '--readahead-mb',
+        dest='readahead_mb',
+        type=int,
+        default=512,
+        help='Memory budget for input games read ahead of the clients asking for them'
+    )
+    parser.add_argument(
+        '--readahead-files',
+        dest='readahead_files',
+        type=int,
+        default=2000,
+        help='Most input games to hold in memory ahead of the clients asking for them. Should cover a few chunks '
+             'for every connected client'
+    )
+    parser.add_argument(
+        '--read-concurrency',
+        dest='read_concurrency',
+        type=int,
+        default=8,
+        help='How many input files may be read at once'
+    )
+    parser.add_argument(
+        '--writer-threads',
+        dest='writer_threads',
+        type=int,
+        default=4,
+        help='How many chunks of results may be written to the output folder at once'
+    )
+    parser.add_argument(
+        '--write-queue-size',
+        dest='write_queue_size',
+        type=int,
+        default=64,
+        help='Chunks of results allowed to wait for the output writer before clients are slowed down'
+    )
+    parser.add_argument(
+        '--fsync',
+        dest='fsync',
+        choices=output_writer.FSYNC_POLICIES,
+        default='file',
+        help='none: let the OS flush output. file: fsync each game before renaming it into place. full: also fsync '
+             'output directories after renaming'
+    )
+    parser.add_argument(
+        '--output-format',
+        dest='output_format',
+        choices=('files', 'shards'),
+        default='files',
+        help='files: mirror the input tree with one .gz per game. shards: append games to large rolling tar shards '
+             'in the output folder, each with a .idx sidecar of member offsets for random access'
+    )
+    parser.add_argument(
+        '--shard-mb',
+        dest='shard_mb',
+        type=int,
+        default=1024,
+        help='Start a new shard once the current one reaches this size'
+    )
+    parser.add_argument(
+        '--shard-max-age',
+        dest='shard_max_age',
+        type=float,
+        default=600,
+        help='Finish a shard that has been open this many seconds even if it is not full. Games in an unfinished '
+             'shard are not counted as done, so this bounds how much work a crash can throw away'
+    )
+    parser.add_argument(
+        '--metrics-port',
+        dest='metrics_port',
+        type=int,
+        default=0,
+        help='If passed, serve Prometheus metrics over HTTP at /metrics on this port'
+    )
+    parser.add_argument(
+        '--metrics-host',
+        dest='metrics_host',
+        default='0.0.0.0',
+        help='Interface to serve metrics on'
+    )
+    parser.add_argument(
+        '--profile-seconds',
+        dest='profile_seconds',
+        type=float,
+        default=30,
+        help='How long to sample stacks for after the server gets SIGUSR1 (kill -USR1 <pid>). With --metrics-port '
+             'a sample can also be pulled from /debug/profile?seconds=N'
+    )
+    parser.add_argument(
+        '--profile-dir',
+        dest='profile_dir',
+        default='.',
+        help='Where SIGUSR1 stack samples are written, as <pid>-<time>.collapsed files for flamegraph.pl'
+    )
     args = parser.parse_args()
     asyncio.run(main(args))
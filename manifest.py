@@ -0,0 +1,136 @@
+import concurrent.futures
+import sqlite3
+import threading
+
+PENDING = 0
+LEASED = 1
+DONE = 2
+FAILED = 3
+
+STATE_NAMES = {
+    PENDING: 'pending',
+    LEASED: 'leased',
+    DONE: 'done',
+    FAILED: 'failed',
+}
+
+PAGE_SIZE = 1000
+
+
+def _report_failure(future):
+    if future.exception() is not None:
+        print(f'failed updating job manifest: {future.exception()!r}')
+
+
+class JobManifest:
+    """Durable record of every input file of a job and whether it is pending, leased, done or failed.
+
+    The first run fills it while the input tree is walked. Once a walk has finished, later runs read pending files
+    straight out of the manifest instead of walking the input and stat()-ing the output tree. Leases don't survive
+    a restart, so anything still leased when the manifest is opened goes back to pending. So do files that couldn't
+    be read, the next run tries them again.
+
+    State changes are called from the event loop, so they only queue the write. A single thread applies them in the
+    order they were made, and nothing on the loop waits for SQLite or for a scanner batch holding the lock.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='manifest')
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, state INTEGER NOT NULL)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            self.conn.execute('UPDATE files SET state = ? WHERE state IN (?, ?)', (PENDING, LEASED, FAILED))
+
+        self.counts = dict.fromkeys(STATE_NAMES, 0)
+        for state, count in self.conn.execute('SELECT state, COUNT(*) FROM files GROUP BY state'):
+            self.counts[state] = count
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'scan_complete'").fetchone()
+        self.scan_complete = row is not None
+
+    def mark_scan_complete(self):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('scan_complete', '1')")
+        self.scan_complete = True
+
+    def add_scanned(self, paths, is_done=None):
+        """Record a batch of paths found by the directory walk, returns the ones that still need scoring.
+
+        Paths the manifest already knows keep their state. New paths start out pending, or done if is_done(path)
+        says the output is already there.
+        """
+        paths = list(paths)
+        known = {}
+        with self.lock:
+            for start in range(0, len(paths), 500):
+                batch = paths[start:start + 500]
+                query = f'SELECT path, state FROM files WHERE path IN ({",".join("?" * len(batch))})'
+                known.update(self.conn.execute(query, batch))
+
+        # is_done may stat() the output tree, keep that outside the lock
+        new_rows = []
+        for path in paths:
+            if path not in known:
+                state = DONE if is_done is not None and is_done(path) else PENDING
+                known[path] = state
+                new_rows.append((path, state))
+
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO files (path, state) VALUES (?, ?)', new_rows)
+            for _, state in new_rows:
+                self.counts[state] += 1
+        return [path for path in paths if known[path] == PENDING]
+
+    def pending_paths(self):
+        # Page through by rowid so state updates made while iterating can't disturb the query
+        last_rowid = 0
+        while True:
+            with self.lock:
+                rows = self.conn.execute(
+                    'SELECT rowid, path FROM files WHERE state = ? AND rowid > ? ORDER BY rowid LIMIT ?',
+                    (PENDING, last_rowid, PAGE_SIZE),
+                ).fetchall()
+            if not rows:
+                return
+            for rowid, path in rows:
+                yield path
+            last_rowid = rows[-1][0]
+
+    def _transition(self, paths, from_state, to_state):
+        with self.lock, self.conn:
+            cursor = self.conn.executemany(
+                'UPDATE files SET state = ? WHERE path = ? AND state = ?',
+                [(to_state, path, from_state) for path in paths],
+            )
+            self.counts[from_state] -= cursor.rowcount
+            self.counts[to_state] += cursor.rowcount
+
+    def _queue_transition(self, paths, from_state, to_state):
+        future = self.executor.submit(self._transition, list(paths), from_state, to_state)
+        future.add_done_callback(_report_failure)
+
+    def mark_leased(self, paths):
+        self._queue_transition(paths, PENDING, LEASED)
+
+    def mark_pending(self, paths):
+        self._queue_transition(paths, LEASED, PENDING)
+
+    def mark_done(self, paths):
+        self._queue_transition(paths, LEASED, DONE)
+
+    def mark_failed(self, paths):
+        self._queue_transition(paths, PENDING, FAILED)
+
+    def progress(self):
+        progress = dict((name, self.counts[state]) for state, name in STATE_NAMES.items())
+        progress['total'] = sum(self.counts.values())
+        return progress
+
+    def close(self):
+        # Apply every queued state change first
+        self.executor.shutdown(wait=True)
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,163 @@
+import asyncio
+import bisect
+import math
+
+import profiling
+
+# Longest stack sample /debug/profile will take, so a typo can't tie up a sampling thread for hours
+MAX_PROFILE_SECONDS = 300
+
+# Seconds, from a fast local disk write up to a chunk scored by a slow rented GPU
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600)
+
+
+def _format_labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = []
+    for name, value in pairs:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append(f'{name}="{value}"')
+    return '{' + ','.join(escaped) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.values = {}
+
+    def inc(self, amount=1, *label_values):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        for label_values, value in self.values.items():
+            yield self.name, _format_labels(self.label_names, label_values), value
+
+
+class Gauge:
+    """Either set() directly or give it a function, called on every scrape, returning {label values tuple: value}."""
+    kind = 'gauge'
+
+    def __init__(self, name, help, label_names=(), function=None):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.function = function
+        self.values = {}
+
+    def set(self, value, *label_values):
+        self.values[label_values] = value
+
+    def samples(self):
+        values = self.function() if self.function is not None else self.values
+        for label_values, value in values.items():
+            yield self.name, _format_labels(self.label_names, label_values), value
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per-bucket counts (last one is +Inf), sum]
+        self.values = {}
+
+    def observe(self, value, *label_values):
+        state = self.values.get(label_values)
+        if state is None:
+            state = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+    def merge(self, buckets, counts, total, *label_values):
+        """Add in a histogram observed somewhere else (a client), bucketed the same way."""
+        if tuple(buckets) != self.buckets or len(counts) != len(self.buckets) + 1:
+            raise ValueError(f'{self.name}: can only merge histograms with buckets {self.buckets}')
+        state = self.values.get(label_values)
+        if state is None:
+            state = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0]
+        for i, count in enumerate(counts):
+            state[0][i] += count
+        state[1] += total
+
+    def samples(self):
+        for label_values, (counts, total) in self.values.items():
+            cumulative = 0
+            for upper, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                labels = _format_labels(self.label_names, label_values, [('le', _format_value(upper))])
+                yield f'{self.name}_bucket', labels, cumulative
+            labels = _format_labels(self.label_names, label_values)
+            yield f'{self.name}_sum', labels, total
+            yield f'{self.name}_count', labels, cumulative
+
+
+class Registry:
+    def __init__(self, prefix=''):
+        self.prefix = prefix
+        self.metrics = []
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, label_names=()):
+        return self._add(Counter(self.prefix + name, help, label_names))
+
+    def gauge(self, name, help, label_names=(), function=None):
+        return self._add(Gauge(self.prefix + name, help, label_names, function))
+
+    def histogram(self, name, help, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(self.prefix + name, help, label_names, buckets))
+
+    def render(self):
+        """Everything in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+async def serve_metrics(registry, host, port):
+    """Serve registry.render() at /metrics on the running event loop.
+
+    /debug/profile?seconds=N samples the server's own stacks for N seconds (default 10) and answers with them in
+    collapsed format, ready for flamegraph.pl.
+    """
+    # sanic is only needed by servers that ask for an HTTP endpoint
+    from sanic import Sanic, response
+
+    app = Sanic('leelenscorer_metrics')
+
+    async def metrics_handler(request):
+        return response.text(registry.render(), content_type='text/plain; version=0.0.4')
+
+    async def profile_handler(request):
+        try:
+            seconds = min(float(request.args.get('seconds', 10)), MAX_PROFILE_SECONDS)
+        except ValueError:
+            return response.text('seconds should be a number\n', status=400)
+        # Sampled from another thread, the event loop keeps running (and shows up in the samples) meanwhile
+        counts = await asyncio.get_event_loop().run_in_executor(None, profiling.sample_stacks, seconds)
+        return response.text(profiling.format_collapsed(counts))
+
+    app.add_route(metrics_handler, '/metrics')
+    app.add_route(profile_handler, '/debug/profile')
+    return await app.create_server(host=host, port=port, access_log=False)
@@ -4,7 +4,9 @@ import socket
 import subprocess
 import time
 
-def spawn_clients(num_gpus, clients_per_gpu, chunk_size, engine, weights, host, port, dry_run, backend, client_name, num_nodes, minibatchsize):
+import search_plan
+
+def spawn_clients(num_gpus, clients_per_gpu, chunk_size, engine, weights, host, port, dry_run, backend, client_name, num_nodes, minibatchsize, pipeline_depth, stage_timing, rescore_full_policies, engine_history, adaptive_nodes=None, min_nodes=1, max_nodes=0):
     subprocs = []
     for i in range(num_gpus):
         for _ in range(clients_per_gpu):
@@ -21,9 +23,22 @@ def spawn_clients(num_gpus, clients_per_gpu, chunk_size, engine, weights, host,
                 f'--client-name={client_name}',
                 f'--num-nodes={num_nodes}',
                 f'--minibatchsize={minibatchsize}',
+                f'--pipeline-depth={pipeline_depth}',
             ]
             if dry_run:
                 process_command.append(f'--dry-run=True')
+            if stage_timing:
+                process_command.append('--stage-timing')
+            if rescore_full_policies:
+                process_command.append('--rescore-full-policies')
+            if engine_history:
+                process_command.append('--engine-history')
+            if adaptive_nodes:
+                process_command.extend([
+                    f'--adaptive-nodes={adaptive_nodes}',
+                    f'--min-nodes={min_nodes}',
+                    f'--max-nodes={max_nodes}',
+                ])
             print(process_command)
             subproc = subprocess.Popen(process_command)
             subprocs.append(subproc)
@@ -36,6 +51,13 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--clients-per-gpu', dest='clients_per_gpu', type=int, default=2)
     parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=5)
+    parser.add_argument(
+        '--pipeline-depth',
+        dest='pipeline_depth',
+        type=int,
+        default=2,
+        help='number of chunks each client asks the server to keep in flight'
+    )
     parser.add_argument(
         '--backend',
         dest='backend',
@@ -92,6 +114,33 @@ if __name__ == '__main__':
         default=1,
         help='number of game nodes to evaluate per move'
     )
+    parser.add_argument(
+        '--stage-timing',
+        dest='stage_timing',
+        action='store_true',
+        help='have every client time each stage of scoring and report it to the server'
+    )
+    parser.add_argument(
+        '--rescore-full-policies',
+        dest='rescore_full_policies',
+        action='store_true',
+        help='have every client also rescore games that already have a full policy'
+    )
+    parser.add_argument(
+        '--engine-history',
+        dest='engine_history',
+        action='store_true',
+        help='have every client send the engine the game history with each position'
+    )
+    parser.add_argument(
+        '--adaptive-nodes',
+        dest='adaptive_nodes',
+        choices=search_plan.ADAPTIVE_MODES,
+        default=None,
+        help='have every client spread its nodes by how uncertain each position is, averaging at most --num-nodes'
+    )
+    parser.add_argument('--min-nodes', dest='min_nodes', type=int, default=1)
+    parser.add_argument('--max-nodes', dest='max_nodes', type=int, default=0)
     parser.add_argument(
         '--minibatchsize',
         dest='minibatchsize',
@@ -117,4 +166,11 @@ if __name__ == '__main__':
         args.client_name,
         args.num_nodes,
         args.minibatchsize,
+        args.pipeline_depth,
+        args.stage_timing,
+        args.rescore_full_policies,
+        args.engine_history,
+        args.adaptive_nodes,
+        args.min_nodes,
+        args.max_nodes,
     )
@@ -0,0 +1,180 @@
+import asyncio
+import concurrent.futures
+import os
+import time
+
+# none: leave flushing to the OS. file: fsync every game before it is renamed into place, so a renamed game is
+# never truncated even after a power cut. full: also fsync the directories after renaming, so the rename itself
+# is durable before the game is marked done.
+FSYNC_POLICIES = ('none', 'file', 'full')
+
+
+class WriteFailed(OSError):
+    """A sink failed in a way that lost more than the chunk it was writing. filenames are every input path that has
+    to be scored again, written the ones it did get on disk before failing."""
+    def __init__(self, message, filenames, written=()):
+        super().__init__(message)
+        self.filenames = list(filenames)
+        self.written = list(written)
+
+
+def fsync_dir(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class FileSink:
+    """Mirrors the input tree, one output file per game.
+
+    Every game goes to a hidden temp file next to its final name and is renamed over it, so the final name only ever
+    holds a complete game.
+    """
+    def __init__(self, output_path_for, fsync_policy):
+        assert fsync_policy in FSYNC_POLICIES, fsync_policy
+        self.output_path_for = output_path_for
+        self.fsync_policy = fsync_policy
+        self.created_dirs = set()
+
+    def _ensure_dir(self, directory):
+        # makedirs is a handful of syscalls per call, only pay for it the first time we see a directory
+        if directory not in self.created_dirs:
+            os.makedirs(directory, exist_ok=True)
+            self.created_dirs.add(directory)
+
+    def _write_one(self, path, data):
+        directory, filename = os.path.split(path)
+        self._ensure_dir(directory)
+        temp_path = os.path.join(directory, f'.{filename}.{os.getpid()}.tmp')
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+                if self.fsync_policy != 'none':
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(temp_path, path)
+        except BaseException:
+            # Don't leave half a game behind, the chunk is written again from scratch
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+        return directory
+
+    def write_chunk(self, filenames, files):
+        """Blocking, returns the input paths whose output is now safely on disk."""
+        written = []
+        touched_dirs = set()
+        for filename, data in zip(filenames, files):
+            touched_dirs.add(self._write_one(self.output_path_for(filename), data))
+            written.append(filename)
+        if self.fsync_policy == 'full':
+            for directory in touched_dirs:
+                fsync_dir(directory)
+        return written
+
+    def flush(self, force=False):
+        return []
+
+    def done_checker(self):
+        """For resume mode, returns a function telling whether an input path already has its output written."""
+        return lambda filename: os.path.exists(self.output_path_for(filename))
+
+
+class OutputWriter:
+    """Writes scored games in the background so clients never wait on the output volume.
+
+    Receivers hand over whole chunks with submit(), which only blocks when queue_size chunks are already waiting.
+    Worker tasks pass each chunk to the sink (FileSink, or shards.ShardSink) in a thread pool. on_written(filenames)
+    is called with the input paths the sink reports as safely on disk, which is the point where it's safe to count
+    them as done. on_failed(filenames) gets the input paths of a chunk the sink could not write, so they can be
+    scored again. Sinks that hold results back (shards) are flushed every flush_period seconds.
+    """
+    def __init__(self, sink, num_workers, queue_size, on_written=None, on_failed=None, flush_period=30,
+                 latency_histogram=None):
+        self.sink = sink
+        self.num_workers = num_workers
+        self.on_written = on_written
+        self.on_failed = on_failed
+        self.flush_period = flush_period
+        self.queue = asyncio.Queue(queue_size)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_workers)
+        self.write_seconds = 0
+        self.num_written = 0
+        # Chunks submitted and not yet written or given up on
+        self.num_pending = 0
+        self.latency_histogram = latency_histogram
+
+    def start(self, loop):
+        for _ in range(self.num_workers):
+            loop.create_task(self._worker())
+        loop.create_task(self._flusher())
+
+    async def submit(self, filenames, files):
+        self.num_pending += 1
+        await self.queue.put((filenames, files))
+
+    def _done(self, written):
+        self.num_written += len(written)
+        if written and self.on_written is not None:
+            self.on_written(written)
+
+    def _failed(self, error, filenames):
+        self._done(getattr(error, 'written', []))
+        filenames = getattr(error, 'filenames', filenames)
+        if filenames and self.on_failed is not None:
+            self.on_failed(filenames)
+
+    async def _worker(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            filenames, files = await self.queue.get()
+            non_empty = [(filename, data) for filename, data in zip(filenames, files) if data]
+            if len(non_empty) < len(filenames):
+                print(f'{len(filenames) - len(non_empty)} empty results in chunk, not writing them')
+            start = time.time()
+            try:
+                written = await loop.run_in_executor(
+                    self.executor,
+                    self.sink.write_chunk,
+                    [filename for filename, _ in non_empty],
+                    [data for _, data in non_empty],
+                )
+            except OSError as e:
+                print(f'failed writing chunk starting with {filenames[0]}: {e}')
+                self._failed(e, [filename for filename, _ in non_empty])
+                continue
+            finally:
+                self.num_pending -= 1
+                self.queue.task_done()
+            elapsed = time.time() - start
+            self.write_seconds += elapsed
+            if self.latency_histogram is not None:
+                self.latency_histogram.observe(elapsed)
+            self._done(written)
+
+    async def finish(self):
+        """Wait for everything queued to be written, then force the sink to flush whatever it is holding back."""
+        await self.queue.join()
+        try:
+            written = await asyncio.get_event_loop().run_in_executor(self.executor, self.sink.flush, True)
+        except OSError as e:
+            print(f'failed flushing output: {e}')
+            self._failed(e, [])
+            return
+        self._done(written)
+
+    async def _flusher(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.flush_period)
+            try:
+                written = await loop.run_in_executor(self.executor, self.sink.flush)
+            except OSError as e:
+                print(f'failed flushing output: {e}')
+                self._failed(e, [])
+                continue
+            self._done(written)
@@ -0,0 +1,87 @@
+DEFAULT_WINDOWS = (60, 300, 3600)
+DEFAULT_FIELDS = ('files', 'positions', 'bytes')
+
+
+class _Window:
+    def __init__(self, seconds, num_buckets, num_fields):
+        self.seconds = seconds
+        self.num_buckets = num_buckets
+        self.bucket_seconds = seconds / num_buckets
+        self.buckets = [[0] * num_fields for _ in range(num_buckets)]
+        self.totals = [0] * num_fields
+        # Absolute index (time // bucket_seconds) of the newest bucket
+        self.current = None
+
+    def advance(self, now):
+        """Move the ring forward to now, dropping buckets that fell out of the window from the running totals."""
+        newest = int(now // self.bucket_seconds)
+        if self.current is None or newest - self.current >= self.num_buckets:
+            for bucket in self.buckets:
+                bucket[:] = [0] * len(bucket)
+            self.totals = [0] * len(self.totals)
+        elif newest > self.current:
+            for index in range(self.current + 1, newest + 1):
+                bucket = self.buckets[index % self.num_buckets]
+                for field, amount in enumerate(bucket):
+                    self.totals[field] -= amount
+                    bucket[field] = 0
+        if self.current is None or newest > self.current:
+            self.current = newest
+
+    def add(self, bucket_index, amounts, share):
+        if bucket_index <= self.current - self.num_buckets or bucket_index > self.current:
+            return
+        bucket = self.buckets[bucket_index % self.num_buckets]
+        for field, amount in enumerate(amounts):
+            bucket[field] += amount * share
+            self.totals[field] += amount * share
+
+    def covered_seconds(self, now):
+        # Full buckets behind the newest one, plus however far into the newest one we are
+        return (self.num_buckets - 1) * self.bucket_seconds + (now - self.current * self.bucket_seconds)
+
+
+class RateTracker:
+    """Sliding-window totals of files, positions and bytes over several windows at once (1m/5m/1h by default).
+
+    Each window is a ring of num_buckets buckets with running totals, so reading a rate is O(1) and recording is O(1)
+    amortized. Work that took `duration` seconds is spread over the buckets it overlaps, so a long chunk doesn't show
+    up as a spike in the short windows.
+    """
+    def __init__(self, windows=DEFAULT_WINDOWS, num_buckets=60, fields=DEFAULT_FIELDS):
+        self.fields = tuple(fields)
+        self.windows = dict((seconds, _Window(seconds, num_buckets, len(self.fields))) for seconds in windows)
+        self.totals = dict.fromkeys(self.fields, 0)
+        # Start of the earliest work recorded, so young trackers aren't averaged over time they didn't exist
+        self.started = None
+
+    def record(self, now, duration=0, **amounts):
+        values = [amounts.get(field, 0) for field in self.fields]
+        for field, value in zip(self.fields, values):
+            self.totals[field] += value
+        start = now - max(duration, 0)
+        if self.started is None or start < self.started:
+            self.started = start
+        for window in self.windows.values():
+            window.advance(now)
+            first = int(start // window.bucket_seconds)
+            last = window.current
+            if first >= last or duration <= 0:
+                window.add(last, values, 1)
+                continue
+            # Only buckets still inside the window can hold anything, the rest of the share is simply dropped
+            for index in range(max(first, last - window.num_buckets + 1), last + 1):
+                bucket_start = max(start, index * window.bucket_seconds)
+                bucket_end = min(now, (index + 1) * window.bucket_seconds)
+                window.add(index, values, (bucket_end - bucket_start) / duration)
+
+    def rates(self, window_seconds, now):
+        """Per-second rate of every field over the given window."""
+        window = self.windows[window_seconds]
+        window.advance(now)
+        covered = window.covered_seconds(now)
+        if self.started is not None:
+            covered = min(covered, now - self.started)
+        if self.started is None or covered <= 0:
+            return dict.fromkeys(self.fields, 0.0)
+        return dict((field, total / covered) for field, total in zip(self.fields, window.totals))
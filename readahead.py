@@ -0,0 +1,129 @@
+import asyncio
+from collections import deque
+import concurrent.futures
+import os
+import time
+
+
+def read_file(path):
+    """Blocking read of a whole input file, telling the kernel up front that we want all of it, in order."""
+    with open(path, 'rb', buffering=0) as f:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        return f.readall()
+
+
+class ReadAhead:
+    """Keeps input files that are about to be handed out already loaded in memory.
+
+    A fixed number of workers pull ScannedFile entries off the DirectoryScanner and read them in a thread pool,
+    so the number of reads hitting the input storage at once is bounded. Loaded files wait in memory until a
+    sender takes them, capped at max_files files and max_bytes bytes (a single file bigger than the byte budget is
+    still let through when nothing else is loaded). Files that can't be read are skipped and handed to
+    on_failed(paths).
+    """
+    def __init__(self, scanner, max_bytes, max_files, concurrency, latency_histogram=None, on_failed=None):
+        self.scanner = scanner
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.concurrency = concurrency
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+        self.ready = deque()
+        # Bytes held by loaded files plus bytes reserved by reads in progress, same for files
+        self.bytes_held = 0
+        self.files_held = 0
+        self.active_workers = 0
+        self.condition = asyncio.Condition()
+        self.read_seconds = 0
+        self.num_read = 0
+        self.latency_histogram = latency_histogram
+        self.on_failed = on_failed
+
+    def start(self, loop):
+        self.active_workers = self.concurrency
+        for _ in range(self.concurrency):
+            loop.create_task(self._worker())
+
+    def _has_room(self, size):
+        if not self.files_held:
+            return True
+        return self.files_held < self.max_files and self.bytes_held + size <= self.max_bytes
+
+    async def _worker(self):
+        loop = asyncio.get_event_loop()
+        try:
+            while True:
+                scanned = await self.scanner.take(1)
+                if not scanned:
+                    return
+                path, size = scanned[0]
+                # Unknown sizes (files from a manifest) only count against the budget once they are read
+                reserved = size or 0
+                async with self.condition:
+                    await self.condition.wait_for(lambda: self._has_room(reserved))
+                    self.bytes_held += reserved
+                    self.files_held += 1
+
+                start = time.time()
+                try:
+                    data = await loop.run_in_executor(self.executor, read_file, path)
+                except OSError as e:
+                    print(f'could not read {path}: {e}')
+                    async with self.condition:
+                        self.bytes_held -= reserved
+                        self.files_held -= 1
+                        self.condition.notify_all()
+                    if self.on_failed is not None:
+                        self.on_failed([path])
+                    continue
+                elapsed = time.time() - start
+                self.read_seconds += elapsed
+                self.num_read += 1
+                if self.latency_histogram is not None:
+                    self.latency_histogram.observe(elapsed)
+
+                async with self.condition:
+                    self.bytes_held += len(data) - reserved
+                    self.ready.append((path, data))
+                    self.condition.notify_all()
+        finally:
+            self.active_workers -= 1
+            async with self.condition:
+                self.condition.notify_all()
+
+    async def take(self, max_files):
+        """Wait until at least one loaded file is available (or there will never be one), return up to max_files
+        (path, data) pairs."""
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.ready or self.active_workers == 0)
+            taken = []
+            while self.ready and len(taken) < max_files:
+                path, data = self.ready.popleft()
+                self.bytes_held -= len(data)
+                self.files_held -= 1
+                taken.append((path, data))
+            self.condition.notify_all()
+            return taken
+
+    async def load(self, paths):
+        """Read specific files straight away, for work that isn't coming through the scanner (requeued leases).
+        Returns (path, data) pairs for the files that could be read."""
+        loop = asyncio.get_event_loop()
+        results = await asyncio.gather(
+            *[loop.run_in_executor(self.executor, read_file, path) for path in paths],
+            return_exceptions=True,
+        )
+        loaded = []
+        failed = []
+        for path, result in zip(paths, results):
+            if isinstance(result, OSError):
+                print(f'could not read {path}: {result}')
+                failed.append(path)
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                loaded.append((path, result))
+        if failed and self.on_failed is not None:
+            self.on_failed(failed)
+        return loaded
@@ -11,8 +11,27 @@ import chess.engine
 import encoding
 import rescore_logic
 import profiling
+import search_plan
+import stage_timer
 
 
+async def receive_chunks(reader, chunk_queue):
+    # Runs alongside scoring so the next chunks are already downloaded by the time the engine is free
+    while True:
+        try:
+            chunk_id, files = await encoding.read_chunk(reader)
+        except IncompleteReadError:
+            print('server sent eof, probably done')
+            chunk_id, files = None, []
+        except (ConnectionError, encoding.ProtocolError) as e:
+            # main still needs the end marker to stop waiting; awaiting this task afterwards re-raises the error
+            print(f'lost the server connection: {e!r}')
+            chunk_queue.put_nowait((None, []))
+            raise
+        await chunk_queue.put((chunk_id, files))
+        if not files:
+            return
+
 
 async def main(args):
     options = {
@@ -33,29 +52,42 @@ async def main(args):
     reader, writer = await asyncio.open_connection(
         args.host,
         args.port,
-        limit=128000,
     )
 
-    encoding.write_payload(writer, [b'ready'])
-    await writer.drain()
+    encoding.write_hello(writer)
 
-    # Declare name and chunk_size for server
-    encoding.write_payload(writer, [str(f'{args.client_name} {str(args.chunk_size)}').encode()])
+    # Declare name, chunk_size and how many chunks we'd like in flight, server answers with the window it allows
+    encoding.write_message(
+        writer,
+        str(f'{args.client_name} {str(args.chunk_size)} {str(args.pipeline_depth)}').encode(),
+    )
     await writer.drain()
+    window = int((await encoding.read_message(reader)).decode())
+    print(f'{os.getpid()} server allows {window} chunks in flight')
+
+    chunk_queue = asyncio.Queue()
+    receiver = asyncio.get_event_loop().create_task(receive_chunks(reader, chunk_queue))
 
+    profiling.install_sampling_signal(args.profile_seconds, args.profile_dir)
+    memory_tracker = None
+    if args.track_memory:
+        memory_tracker = profiling.MemoryTracker()
+        memory_tracker.start()
+
+    timer = stage_timer.StageTimer() if args.stage_timing else stage_timer.NULL_TIMER
+    search_stats = search_plan.SearchStats()
+    node_budget = None
+    if args.adaptive_nodes:
+        node_budget = search_plan.NodeBudget(
+            args.num_nodes,
+            args.min_nodes,
+            args.max_nodes or 4 * args.num_nodes,
+            args.adaptive_nodes,
+        )
     while True:
-        files_to_score = []
-        for _ in range(args.chunk_size):
-            try:
-                new_file = await reader.readuntil(encoding.SEP)
-            except IncompleteReadError:
-                print('server sent eof, probably done')
-                break
-
-            new_file = encoding.remove_sep(new_file)
-            if not new_file:
-                break
-            files_to_score.append(new_file)
+        start = timer.now()
+        chunk_id, files_to_score = await chunk_queue.get()
+        timer.add('wait', start)
 
         if not files_to_score:
             print('no files to score, exiting')
@@ -68,6 +100,7 @@ async def main(args):
                 compressed_unscored_game = await rescore_logic.score_file(
                     file,
                     None,
+                    timer=timer,
                 )
                 scored_files.append(compressed_unscored_game)
             else:
@@ -75,14 +108,38 @@ async def main(args):
                     file,
                     engine,
                     args.num_nodes,
+                    timer=timer,
+                    rescore_full_policies=args.rescore_full_policies,
+                    engine_history=args.engine_history,
+                    search_stats=search_stats,
+                    node_budget=node_budget,
                 )
                 scored_files.append(compressed_scored_game)
         time_elapsed = time.time() - start
 
         print(f'{os.getpid()} finished scoring {len(scored_files)} files in {time_elapsed} seconds, {len(scored_files) / time_elapsed} files-per-second')
-        encoding.write_payload(writer, scored_files)
+        start = timer.now()
+        encoding.write_chunk(writer, chunk_id, scored_files)
+        await writer.drain()
+        timer.add('upload', start)
+
+        # Upload time lands in this chunk's report, the wait for the next chunk in the next one
+        report = timer.report()
+        report['score_seconds'] = time_elapsed
+        report['search'] = search_stats.report()
+        if memory_tracker is not None:
+            report['peak_memory_bytes'] = memory_tracker.take_peak()
+            print(f'{os.getpid()} peak python memory while scoring chunk {report["peak_memory_bytes"] / 1e6:.1f}MB')
+        encoding.write_report(writer, report)
         await writer.drain()
+        if timer.enabled:
+            print(f'{os.getpid()} stages: {timer.summary()}')
+        if not args.dry_run:
+            print(f'{os.getpid()} search: {search_stats.summary()}')
+        timer.reset()
+        search_stats.reset()
 
+    await receiver
     writer.close()
     await writer.wait_closed()
     try:
@@ -96,6 +153,14 @@ if  __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--gpu-id', dest='gpu_id', default='0')
     parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=10)
+    parser.add_argument(
+        '--pipeline-depth',
+        dest='pipeline_depth',
+        type=int,
+        default=2,
+        help='number of chunks to ask the server to keep in flight, so the engine always has queued work while '
+             'results are uploaded and new games downloaded. The server may allow fewer'
+    )
     parser.add_argument(
         '--engine-path',
         dest='path_to_rescore_engine_binary',
@@ -149,7 +214,71 @@ if  __name__ == '__main__':
         dest='num_nodes',
         type=int,
         default=1,
-        help='number of game nodes to evaluate per move'
+        help='number of game nodes to evaluate per move, or on average with --adaptive-nodes'
+    )
+    parser.add_argument(
+        '--adaptive-nodes',
+        dest='adaptive_nodes',
+        choices=search_plan.ADAPTIVE_MODES,
+        default=None,
+        help='spend more nodes on positions whose value is uncertain and fewer on clear cut ones, averaging at most '
+             '--num-nodes. first-pass judges each position by a 1 node search, entropy by the spread of the policy '
+             'already in the record (games without one fall back to first-pass)'
+    )
+    parser.add_argument(
+        '--min-nodes',
+        dest='min_nodes',
+        type=int,
+        default=1,
+        help='fewest nodes a position gets with --adaptive-nodes, as long as that keeps within the --num-nodes average'
+    )
+    parser.add_argument(
+        '--max-nodes',
+        dest='max_nodes',
+        type=int,
+        default=0,
+        help='most nodes a position gets with --adaptive-nodes, 4 times --num-nodes if not given'
+    )
+    parser.add_argument(
+        '--rescore-full-policies',
+        dest='rescore_full_policies',
+        action='store_true',
+        help='also rescore games that already have a full policy (selfplay games, or games scored before), instead '
+             'of sending them back untouched'
+    )
+    parser.add_argument(
+        '--engine-history',
+        dest='engine_history',
+        action='store_true',
+        help='send the engine each position with the game\'s moves so far, so lc0 sees the real history and can '
+             'reuse its search tree from one ply to the next, instead of every position on its own'
+    )
+    parser.add_argument(
+        '--stage-timing',
+        dest='stage_timing',
+        action='store_true',
+        help='time every stage of scoring (gzip, parsing, board replay, engine, policy, packing, upload) and print '
+             'a breakdown per chunk. The breakdown is also sent to the server with the results'
+    )
+    parser.add_argument(
+        '--profile-seconds',
+        dest='profile_seconds',
+        type=float,
+        default=30,
+        help='how long to sample stacks for after the client gets SIGUSR1 (kill -USR1 <pid>)'
+    )
+    parser.add_argument(
+        '--profile-dir',
+        dest='profile_dir',
+        type=str,
+        default='.',
+        help='where SIGUSR1 stack samples are written, as <pid>-<time>.collapsed files for flamegraph.pl or speedscope'
+    )
+    parser.add_argument(
+        '--track-memory',
+        dest='track_memory',
+        action='store_true',
+        help='trace python allocations and report the peak while scoring each chunk. Slows scoring down a bit'
     )
     parser.add_argument(
         '--minibatchsize',
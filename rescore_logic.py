@@ -1,70 +1,42 @@
 import math
 import gzip
-import struct
-from collections import namedtuple
 
 import chess
 import chess.engine
 import np
 
 import constants
-from util import pairwise
-
-V4Encoding = namedtuple(
-    'V4Encoding',
-    [
-        'version',
-        'probs',
-        'planes',
-        'us_ooo',
-        'us_oo',
-        'them_ooo',
-        'them_oo',
-        'stm',
-        'rule50_count',
-        'move_count',
-        'winner',
-        'root_q',
-        'best_q',
-        'root_d',
-        'best_d',
-    ]
-)
+from search_plan import plan_search, SearchPlan, SearchStats, value_uncertainty
+from stage_timer import NULL_TIMER
+import v4
+from v4 import V4Encoding
 
 
 def make_bitboards(planes):
+    pieces = v4.planes_to_bitboards(planes).tolist()
     bitboards = dict(
         white=0,
         black=0,
     )
-    for piece_symbol, idx in zip(constants.PIECES, range(0, 8 * len(constants.PIECES), 8)):
-        current_bitmask = 0
-        pl = planes[idx:idx + 8]
-        for i, byte in enumerate(pl):
-            new_mask = constants.BIT_REVERSE[byte] << ((8 - i - 1) * 8)
-            current_bitmask += new_mask
-            if not piece_symbol.isupper():
-                bitboards['white'] += new_mask
-            else:
-                bitboards['black'] += new_mask
+    for i, piece_symbol in enumerate(constants.PIECES):
+        if not piece_symbol.isupper():
+            bitboards['white'] += pieces[i]
+        else:
+            bitboards['black'] += pieces[i]
         board_attr = constants.SYMBOL_TO_BOARD_ATTR[piece_symbol.upper()]
-        bitboards.setdefault(
-            board_attr,
-            0,
-        )
-        bitboards[board_attr] += current_bitmask
+        bitboards[board_attr] = bitboards.get(board_attr, 0) + pieces[i]
     return bitboards
 
 
-def parse_game(data):
-    for chunk in read_chunks(data, constants.V4_BYTES):
-        move_encoding = V4Encoding(*struct.unpack(constants.V4_STRUCT_STRING, chunk))
-        yield move_encoding
+def board_piece_masks(board):
+    """The 12 piece bitboards of a python-chess board, laid out like a row of v4.planes_to_bitboards."""
+    black, white = board.occupied_co[chess.BLACK], board.occupied_co[chess.WHITE]
+    pieces = (board.pawns, board.knights, board.bishops, board.rooks, board.queens, board.kings)
+    return [piece & black for piece in pieces] + [piece & white for piece in pieces]
 
 
-def read_chunks(data, length):
-    for i in range(0, len(data), length):
-        yield data[i:i + length]
+def parse_game(data):
+    return v4.iter_records(data)
 
 
 def board_equals_planes(board, bitboards):
@@ -74,20 +46,74 @@ def board_equals_planes(board, bitboards):
     return bitboards['white'] == board.occupied_co[chess.WHITE] and bitboards['black'] == board.occupied_co[chess.BLACK]
 
 
-def _infer_move_from_planes_and_current_board(planes, current_board):
-    bitboards = make_bitboards(planes)
-    # Only need the first 8 bits times 12 distinct pieces
-    for legal_move in current_board.legal_moves:
-        current_board.push(legal_move)
-        if board_equals_planes(current_board, bitboards):
-            move = legal_move.uci()
-            current_board.pop()
-            return move
-        current_board.pop()
+def _find_legal_move_reaching(board, bitboards):
+    """The legal move on board that leaves exactly the pieces in bitboards (a row of v4.planes_to_bitboards, as a
+    list), found by trying every one. None if none does."""
+    occupied = 0
+    for bitboard in bitboards:
+        occupied |= bitboard
+    for legal_move in board.legal_moves:
+        board.push(legal_move)
+        # Most moves already leave the wrong squares occupied, only the rest get compared piece by piece
+        if board.occupied == occupied and board_piece_masks(board) == bitboards:
+            board.pop()
+            return legal_move
+        board.pop()
+    return None
 
-    else:
+
+def _infer_move_from_planes_and_current_board(planes, current_board):
+    # Only the first 8 bytes times 12 distinct pieces matter
+    legal_move = _find_legal_move_reaching(current_board, v4.planes_to_bitboards(planes).tolist())
+    if legal_move is None:
         print(f"Couldn't infer next move from planes, board {current_board.fen()}")
         return None
+    return legal_move.uci()
+
+
+def infer_move(board, bitboards):
+    """The move played on board to get to the pieces in bitboards, the position after it laid out like
+    board_piece_masks (a row of v4.planes_to_bitboards for the next record when board has white to move, as in the
+    side to move's frame, or of game_piece_masks).
+
+    The move is read off the squares the mover's pieces left and arrived on, so unlike trying every legal move the
+    cost doesn't depend on the position. Anything that doesn't look like a single move falls back to trying them
+    all. None if no move gets there.
+    """
+    # board_piece_masks has black's pieces first
+    offset = 6 if board.turn == chess.WHITE else 0
+    ours = board.occupied_co[board.turn]
+    ours_after = 0
+    for bitboard in bitboards[offset:offset + 6]:
+        ours_after |= bitboard
+    vacated = ours & ~ours_after
+    arrived = ours_after & ~ours
+
+    move = None
+    if chess.popcount(vacated) == 1 and chess.popcount(arrived) == 1:
+        # Plain moves, captures, en passant (the captured pawn is the opponent's) and promotions
+        promotion = None
+        if vacated & board.pawns and not arrived & bitboards[offset]:
+            promotion = next(
+                (
+                    piece_type for piece_type in range(chess.KNIGHT, chess.KING)
+                    if arrived & bitboards[offset + piece_type - 1]
+                ),
+                None,
+            )
+        move = chess.Move(chess.lsb(vacated), chess.lsb(arrived), promotion)
+    elif chess.popcount(vacated) == 2 and vacated & board.kings and arrived & bitboards[offset + 5]:
+        # Castling, the king and a rook both move. python-chess wants the king's own destination
+        move = chess.Move(chess.lsb(vacated & board.kings), chess.lsb(arrived & bitboards[offset + 5]))
+
+    if move is not None:
+        # Check the whole position, so inconsistent records can't slip through as a wrong move
+        board.push(move)
+        matches = board_piece_masks(board) == bitboards
+        board.pop()
+        if matches:
+            return move
+    return _find_legal_move_reaching(board, bitboards)
 
 
 def q_and_probs_from_engine_score(infos, probs, num_nodes, board, next_move_in_game):
@@ -99,7 +125,7 @@ def q_and_probs_from_engine_score(infos, probs, num_nodes, board, next_move_in_g
         if i == 0:
             q = info["score"].relative.score(mate_score=100) / 10000
         pythonchess_move = info['pv'][0]
-        move = unclean_uci_move_to_lc0(pythonchess_move.uci(), board)
+        move = policy_index(pythonchess_move, board)
         node_count = info['nodes']
 
         total_visited_nodes += node_count
@@ -115,50 +141,135 @@ def q_and_probs_from_engine_score(infos, probs, num_nodes, board, next_move_in_g
     # create writeable probability array
     probs = np.array(probs)
     for move, node_count in move_nodes.items():
-        probs[constants.MOVES_LOOKUP[move]] = node_count / total_visited_nodes
+        probs[move] = node_count / total_visited_nodes
     return q, probs
 
 
-async def score_move(engine, board, move_encoding, probs, num_nodes, next_move_in_game):
+async def score_move(
+        engine,
+        board,
+        game,
+        index,
+        num_nodes,
+        next_move_in_game,
+        timer=NULL_TIMER,
+        clear_policy=False,
+        engine_history=False,
+        search_stats=None,
+        plan=None):
+    """Score position index of game, a writable v4.V4Game, and write the result over its record: the new policy,
+    q in root_q and best_q, and the index of the move played in root_d. Every other field is left as it was, and
+    with no engine (dry run) the record isn't touched at all. board is the real game board, either side to move.
+
+    The search is the one plan_search picks unless a plan is given, and what it spent or saved is added to
+    search_stats. Returns q, or None if there was no engine or the position has a single legal move. Then only the
+    policy and root_d are written, and q is left for score_file to fill in from the next position.
+
+    clear_policy drops the policy already in the record (from selfplay or an earlier rescore) first, so moves the
+    engine didn't visit end up at 0 like in an unscored game.
+
+    engine_history sends the engine the real board with its moves (position startpos moves ...) instead of the side
+    to move's position on its own. lc0 then sees the history planes of the actual game, and consecutive plies
+    continue one another so it can reuse the search tree from the previous one. Its output is flipped back to the
+    side to move's point of view by policy_index.
+    """
     if engine is None:
-        return struct.pack(constants.V4_STRUCT_STRING, *move_encoding)
+        return None
+    if search_stats is None:
+        search_stats = SearchStats()
+
+    start = timer.now()
+    if plan is None:
+        plan = plan_search(board, num_nodes)
+    if not plan.num_nodes:
+        timer.add('replay', start)
+        search_stats.add(engine_calls_saved=1, nodes_saved=num_nodes)
+        return _write_unsearched(board, game, index, plan, next_move_in_game, clear_policy)
+    search_stats.add(
+        engine_calls=1,
+        nodes=plan.num_nodes,
+        multipv_lines_saved=math.ceil(num_nodes / 2) - plan.multipv,
+    )
 
-    engine_kwargs = {}
-    if num_nodes > 1:
-        engine_kwargs['multipv'] = num_nodes
+    # Without engine_history the engine is asked about the position from the side to move's point of view, on its own
+    if engine_history:
+        engine_board, engine_move = board, next_move_in_game
+    elif board.turn == chess.WHITE:
+        engine_board, engine_move = board.copy(stack=False), next_move_in_game
+    else:
+        # Not board.mirror(), that copies the whole move stack first
+        engine_board, engine_move = board.copy(stack=False), flip_move(next_move_in_game)
+        engine_board.apply_mirror()
+    timer.add('replay', start)
 
+    start = timer.now()
     infos = await engine.analyse(
-        board,
-        chess.engine.Limit(nodes=num_nodes),
-        multipv=math.ceil(num_nodes / 2),
+        engine_board,
+        chess.engine.Limit(nodes=plan.num_nodes),
+        multipv=plan.multipv,
     )
+    timer.add('engine', start)
 
+    start = timer.now()
+    probs = game.probs[index]
+    if clear_policy:
+        probs = np.where(np.isnan(probs), probs, np.float32(0))
     q, probs = q_and_probs_from_engine_score(
         infos,
         probs,
-        num_nodes,
-        board,
-        next_move_in_game,
-    )
-
-    return struct.pack(
-        constants.V4_STRUCT_STRING,
-        move_encoding.version,
-        probs.tobytes(),
-        move_encoding.planes,
-        move_encoding.us_ooo,
-        move_encoding.us_oo,
-        move_encoding.them_ooo,
-        move_encoding.them_oo,
-        move_encoding.stm,
-        move_encoding.rule50_count,
-        move_encoding.move_count,
-        move_encoding.winner,
-        q,
-        q,
-        constants.MOVES_LOOKUP[unclean_uci_move_to_lc0(next_move_in_game.uci(), board)],
-        move_encoding.best_d,
+        plan.num_nodes,
+        engine_board,
+        engine_move,
     )
+    timer.add('policy', start)
+
+    start = timer.now()
+    game.probs[index] = probs
+    game['root_q'][index] = q
+    game['best_q'][index] = q
+    game['root_d'][index] = policy_index(next_move_in_game, board)
+    timer.add('pack', start)
+    return q
+
+
+def _write_unsearched(board, game, index, plan, next_move_in_game, clear_policy):
+    """score_move for a position plan_search says needs no search."""
+    if plan.forced_move is None:
+        # No legal moves, the side to move has lost if it's in check and drawn otherwise
+        q = -1.0 if board.is_check() else 0.0
+        game['root_q'][index] = q
+        game['best_q'][index] = q
+        return q
+
+    probs = game.probs[index]
+    if clear_policy:
+        probs[~np.isnan(probs)] = 0
+    probs[policy_index(plan.forced_move, board)] = 1
+    game['root_d'][index] = policy_index(next_move_in_game, board)
+    return None
+
+
+async def _settle_forced(engine, game, forced, q, num_nodes, timer, search_stats):
+    """Write the forced moves leading up to a position worth q, which only now count as searches saved, and fill in
+    their q. A forced move takes the game straight to the next position, so its value is that position's, seen from
+    the other side."""
+    for index, board, move, clear_policy, plan in forced:
+        await score_move(
+            engine,
+            board,
+            game,
+            index,
+            num_nodes,
+            move,
+            timer,
+            clear_policy=clear_policy,
+            search_stats=search_stats,
+            plan=plan,
+        )
+    for index, _, _, _, _ in reversed(forced):
+        q = -q
+        game['root_q'][index] = q
+        game['best_q'][index] = q
 
 
 def _is_single_probability_encoding(probs):
@@ -195,50 +306,288 @@ def unclean_uci_move_to_lc0(move, board):
     return move
 
 
-async def score_file(data, engine, num_nodes=1):
+def move_from_policy_index(index, board):
+    """The python-chess move for an index into constants.MOVES on board, what clean_lc0_to_uci_move and
+    chess.Move.from_uci give, without the strings. With black to move the policy is read from black's point of view
+    and the move comes back flipped onto the real board."""
+    if board.turn == chess.WHITE:
+        variant = constants.POLICY_MOVE_VARIANTS[index]
+        move = constants.POLICY_MOVES[index]
+    else:
+        variant = constants.FLIPPED_POLICY_MOVE_VARIANTS[index]
+        move = constants.FLIPPED_POLICY_MOVES[index]
+    if variant is not None and board.piece_type_at(variant[1].from_square) == variant[0]:
+        return variant[1]
+    return move
+
+
+def policy_index(move, board):
+    """Index into constants.MOVES of a python-chess move on board, what unclean_uci_move_to_lc0 and
+    constants.MOVES_LOOKUP give, without the strings. Black's moves are flipped to black's point of view first."""
+    flip = 0 if board.turn == chess.WHITE else 56
+    from_square, to_square = move.from_square ^ flip, move.to_square ^ flip
+    if from_square == chess.E1 and to_square in constants.CASTLING_POLICY_INDEX and board.kings & chess.BB_SQUARES[
+            chess.E1 ^ flip]:
+        return constants.CASTLING_POLICY_INDEX[to_square]
+    return constants.POLICY_INDEX[constants.policy_key(from_square, to_square, move.promotion)]
+
+
+def flip_move(move):
+    return chess.Move(chess.square_mirror(move.from_square), chess.square_mirror(move.to_square), move.promotion)
+
+
+def game_piece_masks(game):
+    """board_piece_masks of the real position at every record of game, a v4.V4Game starting from white to move,
+    as a (positions, 12) uint64 array.
+
+    Records hold the position from the side to move's point of view, mirrored so the side to move plays black (see
+    v4.planes_to_bitboards). That's already the real board when black is to move. When white is, the board gets
+    flipped back (the ranks are the bytes of each bitboard) and the colours swapped.
+    """
+    bitboards = game.piece_bitboards()
+    white_to_move = bitboards[0::2]
+    bitboards[0::2] = np.concatenate((white_to_move[:, 6:], white_to_move[:, :6]), axis=1).byteswap()
+    return bitboards
+
+
+async def _score_position(
+        engine,
+        board,
+        game,
+        index,
+        num_nodes,
+        move,
+        num_legal_moves,
+        timer,
+        clear_policy,
+        engine_history,
+        search_stats,
+        node_budget,
+        uncertainty,
+        pending_forced=None,
+        search_forced=False):
+    """score_move for one position of score_file. With a node_budget the number of nodes comes from it rather than
+    num_nodes, given how uncertain the position is: uncertainty, or when that's None what a 1 node search says.
+
+    A position with a single legal move isn't written yet. It goes on pending_forced as (index, board, move,
+    clear_policy, plan) for _settle_forced once a later position's value is known, and None is returned.
+    search_forced searches such a position after all, when the game ends before anything settles it. It was
+    already counted as a position the first time round.
+    """
+    if engine is None:
+        return None
+
+    start = timer.now()
+    if search_forced:
+        plan = SearchPlan(num_nodes, 1, None)
+    else:
+        search_stats.add(positions=1)
+        plan = plan_search(board, num_nodes, num_legal_moves)
+    timer.add('replay', start)
+    if plan.forced_move is not None:
+        pending_forced.append((index, board.copy(), move, clear_policy, plan))
+        return None
+    if search_forced and node_budget is not None:
+        # All a forced position needs is its value, the least the budget gives anything
+        num_nodes = node_budget.nodes_for(0)
+        node_budget.spend(num_nodes)
+        plan = SearchPlan(num_nodes, 1, None)
+    if node_budget is None or not plan.num_nodes or search_forced:
+        return await score_move(
+            engine,
+            board,
+            game,
+            index,
+            num_nodes,
+            move,
+            timer,
+            clear_policy=clear_policy,
+            engine_history=engine_history,
+            search_stats=search_stats,
+            plan=plan,
+        )
+
+    if uncertainty is None:
+        # The plain 1 node search, which stands as the result if the budget doesn't give the position any more
+        q = await score_move(
+            engine,
+            board,
+            game,
+            index,
+            1,
+            move,
+            timer,
+            clear_policy=clear_policy,
+            engine_history=engine_history,
+            search_stats=search_stats,
+            plan=SearchPlan(1, 1, None),
+        )
+        search_stats.add(first_pass_calls=1)
+        node_budget.spend(1)
+        num_nodes = node_budget.nodes_for(value_uncertainty(q))
+        if num_nodes <= 1:
+            return q
+        # The 1 node policy is in the record now, it mustn't survive into the real one
+        clear_policy = True
+    else:
+        num_nodes = node_budget.nodes_for(uncertainty)
+
+    node_budget.spend(num_nodes)
+    return await score_move(
+        engine,
+        board,
+        game,
+        index,
+        num_nodes,
+        move,
+        timer,
+        clear_policy=clear_policy,
+        engine_history=engine_history,
+        search_stats=search_stats,
+        plan=plan_search(board, num_nodes, num_legal_moves),
+    )
+
+
+async def score_file(
+        data,
+        engine,
+        num_nodes=1,
+        timer=NULL_TIMER,
+        rescore_full_policies=False,
+        engine_history=False,
+        search_stats=None,
+        node_budget=None):
+    """Rescore a gzipped game, returning it gzipped again.
+
+    Games whose records already carry a full policy (selfplay games, or ones scored before) are returned as they
+    are, unless rescore_full_policies is set. Then the moves played are inferred from the pieces in consecutive
+    records and their policies replaced. engine_history is passed on to score_move, and search_stats counts the
+    engine calls and nodes spent and saved.
+
+    Every position gets num_nodes, unless there's a node_budget (a search_plan.NodeBudget, shared by every game of
+    the job) to hand them out by how uncertain each position is.
+    """
+    if search_stats is None:
+        search_stats = SearchStats()
+    start = timer.now()
     decompressed_data = gzip.decompress(data)
+    timer.add('gzip', start)
+
+    start = timer.now()
+    # Scored positions are written straight over a copy of the input, so the output is the first num_scored records
+    game = v4.V4Game(bytearray(decompressed_data))
+    is_single_probability, played_moves = game.unscored_moves()
+    played_moves = played_moves.tolist()
+    legal_move_counts = game.legal_move_counts().tolist()
+    uncertainties = [None] * len(game)
+    if engine is not None and node_budget is not None and node_budget.mode == 'entropy':
+        # Only a real policy says anything, the rest get a 1 node search to find out
+        uncertainties = [
+            None if is_single else entropy
+            for is_single, entropy in zip(is_single_probability.tolist(), game.policy_entropies().tolist())
+        ]
+    timer.add('parse', start)
+
+    # One real game board. Policies are from the side to move's point of view, move_from_policy_index and
+    # policy_index flip black's moves in and out of it
     board = chess.Board()
-    rescored_game = struct.pack("")
-    for current_encoding, next_encoding in pairwise(parse_game(decompressed_data)):
-        if len(board.piece_map()) == 5:
+    bitboards = None
+    # (index, board, move, clear_policy, plan) of forced moves waiting for the value of a later position
+    forced = []
+    num_scored = 0
+    if engine is not None:
+        search_stats.add(games=1)
+    for i in range(len(game) - 1):
+        start = timer.now()
+        if chess.popcount(board.occupied) == 5:
             break
-        probs = np.frombuffer(current_encoding.probs, dtype=np.float32)
 
         # Find next move that was played in game
-        if _is_single_probability_encoding(probs):
-            move = constants.MOVES[np.nanargmax(probs)]
+        if is_single_probability[i]:
+            m = move_from_policy_index(played_moves[i], board)
+        elif rescore_full_policies:
+            if bitboards is None:
+                bitboards = game_piece_masks(game)
+            m = infer_move(board, bitboards[i + 1].tolist())
+            if m is None:
+                print(f"Couldn't infer move {i} from the next record, returning game as it was")
+                return gzip.compress(decompressed_data)
         else:
-            # For now, return immediately if there is a policy already, indicating we've already scored this game
+            # A policy is already there, indicating we've already scored this game
             return gzip.compress(decompressed_data)
-            """
-            move = _infer_move_from_planes_and_current_board(next_encoding.planes, board)
-            assert move is not None, "Couldn't infer move, failing"
-            """
-
-        move = clean_lc0_to_uci_move(move, board)
-        m = chess.Move.from_uci(move)
+        timer.add('replay', start)
 
-        rescored_game += await score_move(
+        clear_policy = not is_single_probability[i]
+        q = await _score_position(
             engine,
             board,
-            current_encoding,
-            probs,
+            game,
+            i,
             num_nodes,
             m,
+            legal_move_counts[i],
+            timer,
+            clear_policy,
+            engine_history,
+            search_stats,
+            node_budget,
+            uncertainties[i],
+            forced,
         )
+        if q is not None:
+            await _settle_forced(engine, game, forced, q, num_nodes, timer, search_stats)
+            forced = []
+        num_scored += 1
 
+        start = timer.now()
         board.push(m)
-        board = board.mirror()
+        timer.add('replay', start)
 
     # This is a super ugly hack to solve the off-by-one problem iterating through pairwise gives me, just to get this thing working.
-    if rescored_game and len(board.piece_map()) > 5:
-        rescored_game += await score_move(
+    if num_scored and chess.popcount(board.occupied) > 5:
+        # m was played by the other side, flip it to the side to move like the mirrored board always had it
+        clear_policy = rescore_full_policies and not is_single_probability[num_scored]
+        q = await _score_position(
             engine,
             board,
-            next_encoding,
-            np.frombuffer(next_encoding.probs, dtype=np.float32),
+            game,
+            num_scored,
             num_nodes,
-            m,
+            flip_move(m),
+            legal_move_counts[num_scored],
+            timer,
+            clear_policy,
+            engine_history,
+            search_stats,
+            node_budget,
+            uncertainties[num_scored],
+            forced,
+        )
+        if q is not None:
+            await _settle_forced(engine, game, forced, q, num_nodes, timer, search_stats)
+            forced = []
+        num_scored += 1
+
+    # Forced moves at the end have no later position to take their value from, so they get searched after all
+    for index, forced_board, forced_move, clear_policy, _ in forced:
+        await _score_position(
+            engine,
+            forced_board,
+            game,
+            index,
+            num_nodes,
+            forced_move,
+            None,
+            timer,
+            clear_policy,
+            engine_history,
+            search_stats,
+            node_budget,
+            None,
+            search_forced=True,
         )
 
-    return gzip.compress(rescored_game)
+    start = timer.now()
+    compressed = gzip.compress(memoryview(game.data)[:num_scored * constants.V4_BYTES])
+    timer.add('gzip', start)
+    return compressed
@@ -0,0 +1,89 @@
+import asyncio
+from collections import namedtuple
+import os
+import threading
+
+# size is None when the file came from somewhere that doesn't know it, like a job manifest
+ScannedFile = namedtuple('ScannedFile', ['path', 'size'])
+
+
+def walk_gzipped_files(input_dir, filter_text):
+    """Yield every .gz file under input_dir as a ScannedFile, using os.scandir so sizes come with the listing.
+
+    As before, filter_text has to appear in the directory path for that directory's files to be served, but
+    subdirectories of a non-matching directory are still walked.
+    """
+    pending_dirs = [input_dir]
+    while pending_dirs:
+        directory = pending_dirs.pop()
+        serve_files = not filter_text or filter_text in directory
+        try:
+            entries = list(os.scandir(directory))
+        except OSError as e:
+            print(f'could not list {directory}: {e}')
+            continue
+        subdirs = []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.is_dir():
+                # Symlinked directory, which os.walk lists but doesn't descend into either
+                continue
+            elif serve_files and entry.name.endswith('.gz'):
+                try:
+                    size = entry.stat().st_size
+                except OSError:
+                    size = None
+                yield ScannedFile(entry.path, size)
+        # Walk subdirectories in listing order
+        pending_dirs.extend(reversed(subdirs))
+
+
+class DirectoryScanner:
+    """Runs a blocking iterator of ScannedFile in a worker thread and feeds the results into a bounded asyncio.Queue.
+
+    Directory listings, resume-mode stats and manifest reads all happen in the thread, so the event loop never
+    waits on the input filesystem. The thread blocks while the queue is full.
+    """
+    def __init__(self, source, maxsize):
+        self.source = source
+        self.queue = asyncio.Queue(maxsize)
+        self.exhausted = False
+        # Every file of the scan is in the queue or already taken
+        self.finished = False
+        self.num_scanned = 0
+        self.thread = None
+
+    def start(self, loop):
+        self.thread = threading.Thread(target=self._run, args=(loop,), name='directory-scanner', daemon=True)
+        self.thread.start()
+
+    def _run(self, loop):
+        try:
+            for scanned_file in self.source:
+                asyncio.run_coroutine_threadsafe(self.queue.put(scanned_file), loop).result()
+                self.num_scanned += 1
+        finally:
+            asyncio.run_coroutine_threadsafe(self.queue.put(None), loop).result()
+            self.finished = True
+
+    @property
+    def num_ready(self):
+        # Once the scan is over, the end marker sits in the queue for good
+        return self.queue.qsize() - int(self.finished or self.exhausted)
+
+    async def take(self, max_files):
+        """Wait for at least one file unless the scan is over, then take whatever else is ready, up to max_files."""
+        taken = []
+        if self.exhausted or max_files <= 0:
+            return taken
+        scanned_file = await self.queue.get()
+        while scanned_file is not None:
+            taken.append(scanned_file)
+            if len(taken) == max_files or self.queue.empty():
+                return taken
+            scanned_file = self.queue.get_nowait()
+        # Leave the end marker in place for anyone else waiting on the queue
+        self.exhausted = True
+        self.queue.put_nowait(None)
+        return taken
@@ -0,0 +1,128 @@
+import math
+from collections import namedtuple
+
+# How to search one position. num_nodes 0 means no engine call: forced_move is the only legal move, or there is
+# no legal move at all and the position is over
+SearchPlan = namedtuple('SearchPlan', ['num_nodes', 'multipv', 'forced_move'])
+
+# What SearchStats counts, summed over the games of a chunk
+SEARCH_FIELDS = (
+    'games',
+    'positions',
+    'engine_calls',
+    'first_pass_calls',
+    'nodes',
+    'engine_calls_saved',
+    'nodes_saved',
+    'multipv_lines_saved',
+)
+
+
+def plan_search(board, num_nodes, num_legal_moves=None):
+    """The search for the side to move on board with a budget of num_nodes.
+
+    Asks for half as many MultiPV lines as nodes, as score_move always has, but never more lines than there are
+    legal moves. Positions with one legal move or none need no search.
+
+    num_legal_moves is what the record says (v4.V4Game.legal_move_counts). Without it, or when it says the position
+    is forced or over, which is rare enough to double check, legal moves are generated from the board, and only
+    until the answer is known.
+    """
+    multipv = math.ceil(num_nodes / 2)
+    if num_legal_moves is None or num_legal_moves < 2:
+        enough = max(multipv, 2)
+        legal_moves = []
+        for move in board.legal_moves:
+            legal_moves.append(move)
+            if len(legal_moves) >= enough:
+                break
+        if len(legal_moves) == 0:
+            return SearchPlan(0, 0, None)
+        if len(legal_moves) == 1:
+            return SearchPlan(0, 0, legal_moves[0])
+        num_legal_moves = len(legal_moves)
+    return SearchPlan(num_nodes, min(multipv, num_legal_moves), None)
+
+
+# Where NodeBudget gets each position's uncertainty from: a 1 node search of it, or the entropy of the policy in
+# the record (falling back to the 1 node search for records without a real policy)
+ADAPTIVE_MODES = ('first-pass', 'entropy')
+
+
+def value_uncertainty(q):
+    """0 for a position a 1 node search already calls won or lost, 1 for one it calls dead even."""
+    return 1 - min(q * q, 1)
+
+
+class NodeBudget:
+    """Splits a job's nodes between positions by how uncertain each one looks, from 0 (clear cut) to 1.
+
+    A position gets average_nodes scaled by its uncertainty over the mean uncertainty seen so far, kept between
+    min_nodes and max_nodes, then cut back to what is left of average_nodes per position so far (first passes
+    included), so clear cut positions pay for the uncertain ones rather than the other way round. The average wins
+    over min_nodes: only the single node every search needs can take the job past it, and the next positions make
+    up for that, so the nodes spent are never more than one ahead of average_nodes per position.
+    """
+    def __init__(self, average_nodes, min_nodes, max_nodes, mode='first-pass'):
+        if mode not in ADAPTIVE_MODES:
+            raise ValueError(f'adaptive node mode must be one of {ADAPTIVE_MODES}, not {mode}')
+        if not 1 <= min_nodes <= average_nodes:
+            raise ValueError(f'min nodes has to be between 1 and the average of {average_nodes}, not {min_nodes}')
+        self.average_nodes = average_nodes
+        self.min_nodes = min_nodes
+        self.max_nodes = max(max_nodes, self.min_nodes)
+        self.mode = mode
+        self.num_positions = 0
+        self.nodes_spent = 0
+        self.uncertainty_sum = 0.0
+
+    def nodes_for(self, uncertainty):
+        self.num_positions += 1
+        self.uncertainty_sum += uncertainty
+        mean_uncertainty = self.uncertainty_sum / self.num_positions
+        nodes = self.average_nodes * uncertainty / mean_uncertainty if mean_uncertainty else self.average_nodes
+        nodes = round(max(self.min_nodes, min(nodes, self.max_nodes)))
+        left = self.average_nodes * self.num_positions - self.nodes_spent
+        return int(max(1, min(nodes, left)))
+
+    def spend(self, nodes):
+        self.nodes_spent += nodes
+
+
+class SearchStats:
+    """Engine calls and nodes spent, and what plan_search saved, since the last reset. Always on, unlike
+    StageTimer, and sent to the server in the same report after each chunk."""
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counts = dict.fromkeys(SEARCH_FIELDS, 0)
+
+    def add(self, **amounts):
+        for field, amount in amounts.items():
+            self.counts[field] += amount
+
+    def report(self):
+        return dict(self.counts)
+
+    def summary(self):
+        return summarize(self.counts)
+
+
+def summarize(counts):
+    games = counts.get('games', 0)
+    if not games:
+        return 'no games searched'
+    engine_calls = counts.get('engine_calls', 0)
+    return (
+        f'engine calls/game {engine_calls / games:.1f}  '
+        f'nodes/position {nodes_per_position(counts):.1f}  '
+        f'saved calls/game {counts.get("engine_calls_saved", 0) / games:.1f}  '
+        f'saved nodes/game {counts.get("nodes_saved", 0) / games:.1f}  '
+        f'saved multipv lines/game {counts.get("multipv_lines_saved", 0) / games:.1f}'
+    )
+
+
+def nodes_per_position(counts):
+    """Average nodes actually searched per scored position, first passes included."""
+    return counts.get('nodes', 0) / max(counts.get('positions', 0), 1)
@@ -0,0 +1,160 @@
+import io
+import os
+import tarfile
+import threading
+import time
+
+import output_writer
+
+SHARD_SUFFIX = '.tar'
+INDEX_SUFFIX = '.idx'
+
+
+def shard_member_name(input_dir, filepath):
+    return os.path.relpath(filepath, input_dir).replace(os.sep, '/')
+
+
+def load_index(index_path):
+    """Returns {member name: (offset of the data in the shard, size)} from a shard's sidecar index."""
+    entries = {}
+    with open(index_path) as f:
+        for line in f:
+            name, offset, size = line.rstrip('\n').rsplit('\t', 2)
+            entries[name] = (int(offset), int(size))
+    return entries
+
+
+def read_member(shard_path, offset, size):
+    """Random access to one game in a finished shard, using an offset from its index."""
+    with open(shard_path, 'rb') as f:
+        f.seek(offset)
+        return f.read(size)
+
+
+def finished_member_names(output_dir):
+    """Names of every game already in a finished shard under output_dir, for resume mode."""
+    names = set()
+    if not os.path.isdir(output_dir):
+        return names
+    for entry in os.scandir(output_dir):
+        if entry.name.endswith(SHARD_SUFFIX + INDEX_SUFFIX):
+            names.update(load_index(entry.path))
+    return names
+
+
+class ShardSink:
+    """Appends scored games as .gz members of large rolling tar shards in output_dir, the way lc0 training data is
+    shipped, instead of one small file per game.
+
+    A shard is written as a hidden temp file and only renamed to shard-*.tar once it is complete (it reached
+    shard_bytes, or has been open for max_age seconds when the writer flushes). Its index, shard-*.tar.idx, holds one
+    "name<TAB>offset<TAB>size" line per game, offset pointing at the game's bytes inside the tar. Games only count as
+    written once their shard is renamed into place, so a crash loses the open shard but never leaves a done game
+    that isn't on disk. A write that fails drops the open shard and every file in it, and raises
+    output_writer.WriteFailed with all of their input paths so they are scored again.
+    """
+    def __init__(self, output_dir, input_dir, shard_bytes, max_age, fsync_policy):
+        assert fsync_policy in output_writer.FSYNC_POLICIES, fsync_policy
+        self.output_dir = output_dir
+        self.input_dir = input_dir
+        self.shard_bytes = shard_bytes
+        self.max_age = max_age
+        self.fsync_policy = fsync_policy
+        self.lock = threading.Lock()
+        self.num_shards = 0
+        self.shard = None
+        os.makedirs(output_dir, exist_ok=True)
+
+    def _open_shard(self):
+        self.num_shards += 1
+        name = f'shard-{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}-{self.num_shards:05d}{SHARD_SUFFIX}'
+        temp_path = os.path.join(self.output_dir, f'.{name}.tmp')
+        fileobj = open(temp_path, 'wb')
+        self.shard = dict(
+            path=os.path.join(self.output_dir, name),
+            temp_path=temp_path,
+            index_path=os.path.join(self.output_dir, name + INDEX_SUFFIX),
+            temp_index_path=os.path.join(self.output_dir, f'.{name}{INDEX_SUFFIX}.tmp'),
+            fileobj=fileobj,
+            tar=tarfile.open(fileobj=fileobj, mode='w', format=tarfile.GNU_FORMAT),
+            opened=time.time(),
+            index=[],
+            filenames=[],
+        )
+
+    def _finish_shard(self):
+        shard = self.shard
+        shard['tar'].close()
+        if self.fsync_policy != 'none':
+            shard['fileobj'].flush()
+            os.fsync(shard['fileobj'].fileno())
+        shard['fileobj'].close()
+
+        with open(shard['temp_index_path'], 'w') as f:
+            f.writelines(f'{name}\t{offset}\t{size}\n' for name, offset, size in shard['index'])
+            if self.fsync_policy != 'none':
+                f.flush()
+                os.fsync(f.fileno())
+        # The shard is renamed last, a shard-*.tar without its index never exists
+        os.replace(shard['temp_index_path'], shard['index_path'])
+        os.replace(shard['temp_path'], shard['path'])
+        if self.fsync_policy == 'full':
+            output_writer.fsync_dir(self.output_dir)
+        self.shard = None
+        return shard['filenames']
+
+    def _abandon_shard(self):
+        """Drops the open shard after a failed write, whatever stage it got to, returns the input paths it held."""
+        shard = self.shard
+        self.shard = None
+        if shard is None:
+            return []
+        shard['fileobj'].close()
+        # The index goes first, an index without its shard would make resume mode skip games that aren't written
+        for path in (shard['index_path'], shard['temp_index_path'], shard['path'], shard['temp_path']):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        return shard['filenames']
+
+    def write_chunk(self, filenames, files):
+        finished = []
+        with self.lock:
+            try:
+                for filename, data in zip(filenames, files):
+                    if self.shard is None:
+                        self._open_shard()
+                    tarinfo = tarfile.TarInfo(shard_member_name(self.input_dir, filename))
+                    tarinfo.size = len(data)
+                    tarinfo.mtime = int(time.time())
+                    tar = self.shard['tar']
+                    tar.addfile(tarinfo, io.BytesIO(data))
+                    # offset_data is only filled in when reading a tar, when writing the data is the last padded blocks
+                    data_offset = tar.offset - -(-len(data) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+                    self.shard['index'].append((tarinfo.name, data_offset, tarinfo.size))
+                    self.shard['filenames'].append(filename)
+                    if self.shard['fileobj'].tell() >= self.shard_bytes:
+                        finished.extend(self._finish_shard())
+            except OSError as e:
+                lost = self._abandon_shard()
+                # Files of this chunk that never made it into a shard
+                accounted = set(lost) | set(finished)
+                lost.extend(filename for filename in filenames if filename not in accounted)
+                raise output_writer.WriteFailed(f'{e}, dropped the open shard', lost, finished) from e
+        return finished
+
+    def flush(self, force=False):
+        with self.lock:
+            if self.shard is None or not self.shard['filenames']:
+                return []
+            if force or time.time() - self.shard['opened'] >= self.max_age:
+                try:
+                    return self._finish_shard()
+                except OSError as e:
+                    raise output_writer.WriteFailed(f'{e}, dropped the open shard', self._abandon_shard()) from e
+            return []
+
+    def done_checker(self):
+        finished = finished_member_names(self.output_dir)
+        return lambda filename: shard_member_name(self.input_dir, filename) in finished
@@ -0,0 +1,142 @@
+import struct
+from collections import namedtuple
+
+import np
+
+import constants
+
+POLICY_SIZE = constants.POLICY_BYTES // 4
+NUM_PLANES = 104
+
+V4Encoding = namedtuple(
+    'V4Encoding',
+    [
+        'version',
+        'probs',
+        'planes',
+        'us_ooo',
+        'us_oo',
+        'them_ooo',
+        'them_oo',
+        'stm',
+        'rule50_count',
+        'move_count',
+        'winner',
+        'root_q',
+        'best_q',
+        'root_d',
+        'best_d',
+    ]
+)
+
+# Same layout as constants.V4_STRUCT_STRING, one element per position. lc0 writes its training data little endian.
+V4_DTYPE = np.dtype([
+    ('version', '<i4'),
+    ('probs', '<f4', (POLICY_SIZE,)),
+    # 104 planes of 8 bytes, byte k of a plane is rank k from the side to move's point of view
+    ('planes', 'u1', (NUM_PLANES, 8)),
+    ('us_ooo', 'u1'),
+    ('us_oo', 'u1'),
+    ('them_ooo', 'u1'),
+    ('them_oo', 'u1'),
+    ('stm', 'u1'),
+    ('rule50_count', 'u1'),
+    ('move_count', 'u1'),
+    ('winner', 'i1'),
+    ('root_q', '<f4'),
+    ('best_q', '<f4'),
+    ('root_d', '<f4'),
+    ('best_d', '<f4'),
+])
+assert V4_DTYPE.itemsize == constants.V4_BYTES == struct.calcsize(constants.V4_STRUCT_STRING)
+
+_V4_STRUCT = struct.Struct(constants.V4_STRUCT_STRING)
+
+NUM_PIECE_PLANES = len(constants.PIECES)
+# Within a plane byte file a is the high bit, python-chess has it as the low bit
+_BIT_REVERSE = np.array(constants.BIT_REVERSE, dtype=np.uint8)
+
+
+def iter_records(data):
+    """V4Encoding per position, the record at a time interface rescore_logic.parse_game has always had."""
+    return map(V4Encoding._make, _V4_STRUCT.iter_unpack(data))
+
+
+def planes_to_bitboards(planes):
+    """Bitboards of the 12 pieces of the current position, in constants.PIECES order, from the planes of one record
+    (the 832 plane bytes, or a (104, 8) array) or of many at once (a (..., 104, 8) array, like V4Game.planes).
+
+    Returns uint64 (..., 12), in the same frame as rescore_logic.make_bitboards: upper case (side to move) pieces
+    end up as black's, and the board is flipped so it matches the position before the side to move was mirrored.
+    """
+    if isinstance(planes, (bytes, bytearray, memoryview)):
+        planes = np.frombuffer(planes, dtype=np.uint8, count=NUM_PIECE_PLANES * 8).reshape(NUM_PIECE_PLANES, 8)
+    # Byte k of a plane becomes the k-th most significant byte, so the 8 reversed bytes are one big endian uint64
+    reversed_bytes = _BIT_REVERSE[planes[..., :NUM_PIECE_PLANES, :]]
+    return reversed_bytes.view('>u8')[..., 0].astype(np.uint64)
+
+
+class V4Game:
+    """A whole decompressed V4 game mapped as one structured array, without copying it.
+
+    Columns are views into the buffer: probs is (positions, 1858) float32, planes (positions, 104, 8) uint8, and
+    so on for every field of V4_DTYPE. Pass a bytearray to get writable views.
+    """
+    def __init__(self, data):
+        if len(data) % constants.V4_BYTES:
+            raise ValueError(f'{len(data)} bytes is not a whole number of {constants.V4_BYTES} byte V4 records')
+        self.data = data
+        self.records = np.frombuffer(data, dtype=V4_DTYPE)
+        # Making a field view costs more than writing one value through it, so make each one once
+        self.columns = dict((field, self.records[field]) for field in V4_DTYPE.names)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, field):
+        return self.columns[field]
+
+    @property
+    def probs(self):
+        return self.columns['probs']
+
+    @property
+    def planes(self):
+        return self.columns['planes']
+
+    def piece_bitboards(self):
+        """planes_to_bitboards for every position, (positions, 12) uint64."""
+        return planes_to_bitboards(self.planes)
+
+    def encodings(self):
+        return iter_records(self.data)
+
+    def _nonzero_policy(self):
+        probs = self.probs
+        # nan != 0, so nans have to be ruled out separately
+        return (probs != 0) & ~np.isnan(probs)
+
+    def single_probability_mask(self):
+        """Which positions have the policy of an unscored game (p=1 on the move played, 0 on other legal moves,
+        nan elsewhere), rescore_logic._is_single_probability_encoding for every position at once."""
+        return np.add.reduce(self._nonzero_policy().view(np.uint8), axis=1, dtype=np.uint16) == 1
+
+    def legal_move_counts(self):
+        """Number of legal moves at each position, which are the moves with a policy (illegal moves are nan)."""
+        return np.add.reduce((~np.isnan(self.probs)).view(np.uint8), axis=1, dtype=np.uint16)
+
+    def policy_entropies(self):
+        """Entropy of each position's policy over its legal moves, over the most it could be (log of the number of
+        legal moves): 0 when one move has all of it, 1 when they all have the same. 0 as well for positions with
+        fewer than two legal moves."""
+        probs = np.nan_to_num(self.probs)
+        plogp = probs * np.log(np.where(probs > 0, probs, 1))
+        counts = self.legal_move_counts()
+        return np.where(counts > 1, -plogp.sum(axis=1) / np.log(np.maximum(counts, 2)), 0)
+
+    def unscored_moves(self):
+        """(single_probability_mask(), index into constants.MOVES of the move played at each of those positions),
+        from one pass over the policies. The move index means nothing where the mask is False."""
+        nonzero = self._nonzero_policy()
+        mask = np.add.reduce(nonzero.view(np.uint8), axis=1, dtype=np.uint16) == 1
+        return mask, nonzero.argmax(axis=1)